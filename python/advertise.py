@@ -47,7 +47,7 @@ class AdarListener(ServiceListener):
 			return
 		short_key = "-".join(f"{int(bit):03d}" for bit in peer.shared_key[:2])
 		print(f"\tkey: {short_key}")
-		sync = storage_sync.transmit(peer, storage_sync.Command.SYNC).join()
+		sync = storage_sync.transmit(peer, storage_sync.Command.SYNC).result()
 		if not sync:
 			print(peer.friendly_name, "couldn't sync, disconnecting")
 			peer.connection.shutdown(socket.SHUT_RDWR)
@@ -57,7 +57,7 @@ class AdarListener(ServiceListener):
 			return
 		peer.we_ready = storage_sync.sync().join()
 		print("we are ready, telling peer")
-		peer.ready = storage_sync.transmit(peer, storage_sync.Command.READY).join()
+		peer.ready = storage_sync.transmit(peer, storage_sync.Command.READY).result()
 		if not peer.ready:
 			print(peer.friendly_name, "not ready, disconnecting")
 			peer.connection.shutdown(socket.SHUT_RDWR)
@@ -4,8 +4,37 @@ ID = machineid.id().strip()  # unique ID for this instance
 PORT = 6780  # port used for TCP transmission of control
 DATA_PORT = 6781  # port used for UDP transmission of data
 SERVICE = "_adar._tcp.local."  # suffix for DNS-SD service
-SUPPORTED_VERSIONS = [1]  # versions supported by this implementation / instance
+SUPPORTED_VERSIONS = [2]  # versions supported by this implementation / instance, 2 adds the layout to STATS and offsets to DATA and WRITE
 
 MOUNT_POINT = "mount"  # for presenting to the OS / user
 SYMBOL_DIRECTORY = ".symbols"  # holds symbols
-METADATA_DIRECTORY = ".metadata"  # holds file metadata
\ No newline at end of file
+METADATA_DIRECTORY = ".metadata"  # holds file metadata
+PLAN_DIRECTORY = ".plans"  # holds cached decoding plans, when enabled
+METADATA_BACKEND = "json"  # "json" for a file per path in METADATA_DIRECTORY, "sqlite" for METADATA_DATABASE
+METADATA_DATABASE = ".metadata.db"  # holds file metadata with the sqlite backend, see migrate_metadata.py
+
+GENERATION_SIZE = 128  # source symbols per generation, each generation is coded independently
+SYMBOL_SIZE = 64  # bytes per source and coded symbol
+REDUNDANCY = 2.0  # coded symbols stored per source symbol, for files no other rule matches, must be more than 1.0
+MIN_EXTRA_SYMBOLS = 32  # coded symbols beyond the source symbols of a full generation at the least, lower redundancy is raised to meet it
+REDUNDANCY_BY_SIZE: list[tuple[int, float]] = []  # (minimum length, redundancy), the largest matching length wins, e.g. [(64 * 1024 * 1024, 1.25)] for large media
+REDUNDANCY_DIRECTORIES: dict[str, float] = {}  # redundancy for everything below a directory, the longest match wins over size rules, e.g. {"/documents": 2.0}
+PLAN_CACHE_SIZE = 1024  # decoding plans kept in memory
+PLAN_CACHE_ON_DISK = False  # also keep decoding plans in PLAN_DIRECTORY across restarts
+PLAN_CACHE_DISK_BYTES = 256 * 1024 * 1024  # decoding plans kept in PLAN_DIRECTORY, least recently used are deleted first
+METADATA_FLUSH_INTERVAL = 1.0  # seconds between writing out changed metadata, 0 writes through on every change
+METADATA_CACHE_SIZE = 65536  # metadata entries kept in memory, least recently used clean ones are evicted first
+METADATA_FSYNC = False  # fsync metadata files on every flush, not just on fsync and shutdown
+ATIME_MODE = "relatime"  # "strict" updates atime on every read, "relatime" only when older than mtime or a day old, "noatime" never
+RELATIME_INTERVAL_NS = 24 * 60 * 60 * 1_000_000_000  # how old atime gets before a read updates it under relatime
+WRITE_BUFFER_BYTES = 8 * 1024 * 1024  # buffered writes per open file before they are encoded and replicated
+WRITE_BUFFER_DELAY = 5.0  # seconds after the first buffered write that it is encoded and replicated at the latest
+FUSE_THREADS = True  # serve FUSE calls from many threads, files are locked per path by storage_locks
+READAHEAD_BYTES = 4 * 1024 * 1024  # decoded ahead of a sequential reader at most, the window starts at one read and doubles while the reader outruns it
+READAHEAD_THREADS = 2  # background threads decoding ahead for all open files
+WRITE_PACKET_BYTES = 32 * 1024  # file bytes replicated per datagram, well under the 64 KiB UDP limit with the header
+TRANSMIT_DATA_THREADS = 8  # threads sending network coded data to peers, shared by all peers
+ATTR_TIMEOUT = 1.0  # seconds the kernel caches file attributes, and the FUSE attribute cache keeps them
+ATTR_CACHE_SIZE = 65536  # getattr results kept by the FUSE attribute cache at most, expired ones are dropped sooner
+ENTRY_TIMEOUT = 1.0  # seconds the kernel caches name lookups
+DATA_CACHE_BYTES = 64 * 1024 * 1024  # decoded file contents kept in memory, per generation
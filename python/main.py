@@ -1,3 +1,4 @@
+import copy
 import signal
 import socket
 import select
@@ -6,8 +7,9 @@ import threading
 from Crypto.Cipher import ChaCha20_Poly1305
 from time import sleep
 
+import storage_coding
 import storage_sync
-from simplenc import BinaryCoder
+from simplenc import BinaryCoder, unpack_bits
 from advertise import *
 from constants import *
 from peer import *
@@ -118,8 +120,8 @@ class AdarHandler(socketserver.StreamRequestHandler):
 						self.data = f"{folders}:{files}\n".encode()
 					case storage_sync.Command.STATS:
 						path = arguments
-						size, ctime, mtime, atime = storage_sync.stats_local(path)
-						self.data = f"{size}{storage_sync.SEP}{ctime}{storage_sync.SEP}{mtime}{storage_sync.SEP}{atime}\n".encode()
+						size, ctime, mtime, atime, generation_size, symbol_size, redundancy = storage_sync.stats_local(path)
+						self.data = f"{size}{storage_sync.SEP}{ctime}{storage_sync.SEP}{mtime}{storage_sync.SEP}{atime}{storage_sync.SEP}{generation_size}{storage_sync.SEP}{symbol_size}{storage_sync.SEP}{redundancy}\n".encode()
 					case storage_sync.Command.CREATE:
 						path, directory, seed = arguments.split(storage_sync.SEP)
 						try:
@@ -205,8 +207,7 @@ class AdarDataHandler():
 			skip, equations = arguments.decode().split(storage_sync.SEP)
 			skip = int(skip)
 			equations = int(equations)
-			seed, symbols = storage_sync.read_local(path, skip, equations)
-			data = bytes(symbols)
+			seed, data = storage_sync.read_local(path, skip, equations)
 		if command == storage_sync.Command.DATA or command == storage_sync.Command.WRITE:
 			"""Recieved network-coded data, decode and decrypt"""
 			path = header[1:].decode()
@@ -217,6 +218,10 @@ class AdarDataHandler():
 			i += 8
 			seed = int.from_bytes(arguments[i:i+8], "big")
 			i += 8
+			skip = int.from_bytes(arguments[i:i+8], "big")
+			i += 8
+			file_length = int.from_bytes(arguments[i:i+8], "big")
+			i += 8
 			nonce = arguments[i:i+24]
 			i += 24
 			coefficient = int.from_bytes(arguments[i:i+4], "big")
@@ -229,40 +234,25 @@ class AdarDataHandler():
 			i += 16
 			# decoding
 			if command == storage_sync.Command.DATA:
-				if storage_sync.reads[path].decoder == None or storage_sync.reads[path].decoder.seed != seed:
-					storage_sync.reads[path].decoder = BinaryCoder(storage_sync.reads[path].decoder.num_symbols, 8, seed)
+				if storage_sync.reads[path].decoder.seed != seed:
+					# copied, the decoder's metadata may be the live local metadata for the path
+					metadata = copy.copy(storage_sync.reads[path].decoder.metadata)
+					metadata.seed = seed
+					storage_sync.reads[path].decoder = storage_coding.FileDecoder(metadata)
 			# TODO: figure how to handle multiple packets / symbols
-			decoder = BinaryCoder(symbols, payload_length, 1)
-			coefficient = [coefficient >> i & 1 for i in range(32 - 1, -1, -1)]
-			bits = []
-			for byte in data:
-				bits.extend([byte >> i & 1 for i in range(8 - 1, -1, -1)])
-			coefficient = coefficient[-symbols:]
-			decoder.consume_packet(coefficient, bits)
+			decoder = BinaryCoder(symbols, payload_length * 8, 1)
+			coefficient = unpack_bits(coefficient, symbols)
+			decoder.consume_block(coefficient, data)
 			# reassembly
-			data = []
-			for symbol in range(decoder.num_symbols):
-				if decoder.is_symbol_decoded(symbol):
-					bits = decoder.get_decoded_symbol(symbol)
-					bits = "".join(map(str, bits))
-					data.extend([int(bits[i:i+8], 2) for i in range(0, len(bits), 8)])
-			data = bytes(data)
+			data = decoder.get_decoded_payload()
 			# decryption, XChaCha20-Poly1305
 			cipher = ChaCha20_Poly1305.new(key=peer.shared_key[-32:], nonce=nonce)
 			cipher.update(path.encode())
 			plaintext = cipher.decrypt_and_verify(data, tag)
 			if command == storage_sync.Command.DATA:
 				# process the coded symbols still, not actual file data yet
-				for byte in plaintext:
-					coefficient, _ = storage_sync.reads[path].decoder.generate_coefficients()
-					bits = [byte >> i & 1 for i in range(8 - 1, -1, -1)]
-					storage_sync.reads[path].decoder.consume_packet(coefficient, bits)
-				output = bytearray(storage_sync.reads[path].decoder.num_symbols)
-				for i in range(storage_sync.reads[path].decoder.num_symbols):
-					if storage_sync.reads[path].decoder.is_symbol_decoded(i):
-						symbol = storage_sync.reads[path].decoder.get_decoded_symbol(i)
-						output[i:i+1] = int("".join(map(str, symbol)), 2).to_bytes(1, "big")
-				plaintext = bytes(output)
+				storage_sync.reads[path].decoder.consume(plaintext)
+				plaintext = storage_sync.reads[path].decoder.data()
 		match command:
 			case storage_sync.Command.READ:
 				storage_sync.transmit_data(peer, storage_sync.Command.DATA, path, data, seed=seed, skip=skip)
@@ -273,7 +263,7 @@ class AdarDataHandler():
 			case storage_sync.Command.WRITE:
 				"""Received a write command, process network-coded data"""
 				print("UDP", peer.friendly_name, f"data to write: {path}", plaintext)
-				storage_sync.write_local(path, 0, len(plaintext), plaintext)
+				storage_sync.write_local(path, skip, len(plaintext), plaintext, file_length)
 	
 	def shutdown(self):
 		self.stop = True
@@ -291,6 +281,7 @@ def handle(signum, frame):
 	for peer in peer_list:
 		if peer.ready:
 			storage_sync.transmit(peer, storage_sync.Command.DISCONNECT)
+	storage_sync.shutdown()
 	if os.name == "posix":
 		storage_fuse.destroy()
 	if os.name == "nt":
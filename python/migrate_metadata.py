@@ -0,0 +1,40 @@
+import os
+import sys
+
+import storage_database
+from constants import *
+from storage_metadata import metadata_key, read_json_metadata
+
+# Copies the per-file JSON metadata in METADATA_DIRECTORY into METADATA_DATABASE
+# The JSON files are left in place: they still make up the namespace for the mount
+# Run it while adar is stopped, then set METADATA_BACKEND = "sqlite"
+
+
+def main():
+	if not os.path.isdir(METADATA_DIRECTORY):
+		print(f"{METADATA_DIRECTORY} does not exist, nothing to migrate")
+		sys.exit(1)
+	entries = []
+	directories = 0
+	for root, folders, files in os.walk(METADATA_DIRECTORY):
+		relative = os.path.relpath(root, METADATA_DIRECTORY)
+		relative = "" if relative == "." else relative
+		for folder in folders:
+			storage_database.add_directory(metadata_key(os.path.join(relative, folder)))
+			directories += 1
+		for file in files:
+			path = metadata_key(os.path.join(relative, file))
+			try:
+				metadata = read_json_metadata(path)
+			except ValueError:
+				print(f"skipping {path}, not valid metadata")
+				continue
+			if metadata is None:
+				continue
+			entries.append((path, {field: getattr(metadata, field) for field in storage_database.FIELDS}))
+	storage_database.store_many(entries, fsync=True)
+	print(f"migrated {len(entries)} files and {directories} directories into {METADATA_DATABASE}")
+
+
+if __name__ == "__main__":
+	main()
@@ -59,7 +59,8 @@ def request_pair(peer: Peer) -> bool:
 		connection.close()
 		return
 	peer.connection = connection
-	return storage_sync.transmit(peer, storage_sync.Command.PAIR).join(30)
+	# timed out on the socket, so an unanswered request doesn't hold up the peer's dispatcher
+	return storage_sync.transmit(peer, storage_sync.Command.PAIR, timeout=30).result()
 
 
 def store_peer(peer: Peer):
@@ -105,12 +106,12 @@ def connect(peer: Peer):
 			connection.close()
 			return
 		peer.connection = connection
-	version: int = storage_sync.transmit(peer, storage_sync.Command.CONNECT).join()
+	version: int = storage_sync.transmit(peer, storage_sync.Command.CONNECT).result()
 	if version not in SUPPORTED_VERSIONS:
 		return False
 	peer.version = version
 	our_key = peer.generator.get_public_key()
-	other_key = storage_sync.transmit(peer, storage_sync.Command.KEY, None, base64.b64encode(our_key)).join()
+	other_key = storage_sync.transmit(peer, storage_sync.Command.KEY, None, base64.b64encode(our_key)).result()
 	peer.shared_key = peer.generator.generate_shared_key(other_key)
 
 	family: socket.AddressFamily
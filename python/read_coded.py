@@ -1,6 +1,6 @@
-from simplenc import BinaryCoder
+from storage_coding import FileDecoder
 
 
 class ReadCoded:
 	data: bytes | bytearray = None
-	decoder: BinaryCoder = None
\ No newline at end of file
+	decoder: FileDecoder = None
\ No newline at end of file
@@ -9,5 +9,6 @@ setuptools.setup(
     py_modules=["simplenc"],
     packages=setuptools.find_packages(),
     install_requires=[],
+    extras_require={"numpy": ["numpy"]},
     classifiers=[],
 )
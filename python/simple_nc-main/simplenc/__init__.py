@@ -1,3 +1,11 @@
 name = "simplenc"
 
-from .binary_network_coder import *
\ No newline at end of file
+from .binary_network_coder import *
+from .gf256_network_coder import *
+from .gf256_utilities import *
+
+try:
+    from .numpy_binary_coder import NumpyBinaryCoder
+except ImportError:
+    # numpy is an optional dependency, install with `pip install .[numpy]`
+    pass
@@ -1,12 +1,16 @@
+import bisect
+import functools
 import random
-from .matrix_utilities import bin_mat_rref, bin_mat_dot, identity
+from .matrix_utilities import bin_mat_rref, bin_mat_dot, identity, pack_bits, unpack_bits, pack_coefficients, unpack_coefficients
 
 
 class BinaryCoder(object):
     """ Network Coding class allowing for operations on binary field.
 
     Performance is sacrified by keeping to python data types.
-    However, this allows for a much more simple implementation which can be easily undestood.
+    However, each coefficient row and each packet is bit-packed into a single python int,
+    so that adding two rows is a single XOR instead of an elementwise loop.
+    Coefficient i is stored at bit i, packets are stored with their first bit as the most significant.
     """
     
     NUM_D_TYPE = int # The datatype of underlying numpy arrays
@@ -14,6 +18,7 @@ class BinaryCoder(object):
     def __init__(self, num_symbols, packet_size, rng_seed):
         self.num_symbols = num_symbols
         self.num_bit_packet = packet_size
+        self.num_byte_packet = (packet_size + 7) // 8
         self.random = random.Random()
         self.random.seed(rng_seed)
         self.seed = rng_seed
@@ -21,58 +26,92 @@ class BinaryCoder(object):
 
     def reset(self):
         self.num_independent = 0
+        self.num_decoded = 0
         self.symbol_decoded = [False] * self.num_symbols
-        self.id = identity(self.num_symbols)
-        # Add identity to track transformation of rref
-        # See: https://stackoverflow.com/questions/43495305/transformation-matrix-of-reduced-row-echelon-form
-        self.coefficient_matrix = [ [0] * self.num_symbols + self.id[k] for k in range(self.num_symbols)] # save current rref to reduce computational load in the future
-        self.packet_vector = [ [0] * self.num_bit_packet  for _ in range(self.num_symbols)]
+        # current rref, with the row whose leading one is in column k stored at index k
+        self.coefficient_matrix = [0] * self.num_symbols
+        self.packet_vector = [0] * self.num_symbols
+        self.pivots = [] # sorted columns holding a leading one
+        self.pivot_mask = 0
 
     def is_symbol_decoded(self, index):
         """Returns the decoding status for a given symbol at index."""
         return self.symbol_decoded[index]
 
-    def get_decoded_symbol(self, index):
+    def get_decoded_symbol(self, index, packed=False):
         """Returns the symbol if already decoded, otherwise returns None."""
         symbol = None
         if self.is_symbol_decoded(index):
             symbol = self.packet_vector[index]
+            if not packed:
+                symbol = unpack_bits(symbol, self.num_bit_packet)
         return symbol
 
     def get_num_decoded(self):
-        return sum(self.symbol_decoded)
+        return self.num_decoded
 
     def is_fully_decoded(self):
         """Returns true, if all symbols are decoded."""
-        return all(self.symbol_decoded)
+        return self.num_decoded == self.num_symbols
 
     def rank(self):
         """Returns current rank of the coefficient matrix."""
         return self.num_independent
 
     def consume_packet(self, coefficients, packet):
-        """Processes an encoded symbol together with its coefficients."""
-        if not self.is_fully_decoded():
-            # add new symbol to decoder matrix and packet vector
-            self.coefficient_matrix[self.num_independent][0:self.num_symbols] = coefficients
-            self.packet_vector[self.num_independent] = packet
-            # calculate row reduced echolon form
-            extended_rref, self.num_independent, self.symbol_decoded = bin_mat_rref(self.coefficient_matrix)
-            # extract transformation matrix
-            transformation = [row[self.num_symbols:2*self.num_symbols] for row in extended_rref]
-            # apply transformation to the packet vector as well
-            self.packet_vector = bin_mat_dot(transformation,self.packet_vector)
-            # extract rref matrix
-            rref = [row[0:self.num_symbols] for row in extended_rref]
-            # construct new extended coefficient matrix
-            self.coefficient_matrix = [rref[k] + self.id[k] for k in range(self.num_symbols)]
+        """Processes an encoded symbol together with its coefficients.
+
+        Both may be given as lists of bits or already bit-packed as ints.
+        The new row is reduced against the existing pivots and back-substituted once, so each packet costs O(n) row operations.
+        Returns true, if the packet was innovative.
+        """
+        if self.is_fully_decoded():
+            return False
+        if not isinstance(coefficients, int):
+            coefficients = pack_coefficients(coefficients)
+        if not isinstance(packet, int):
+            packet = pack_bits(packet)
+        # reduce the new row against the pivots we already have
+        # pivot rows are zero in every other pivot column, so each XOR only clears its own column
+        pending = coefficients & self.pivot_mask
+        while pending:
+            lowest = pending & -pending
+            pivot = lowest.bit_length() - 1
+            coefficients ^= self.coefficient_matrix[pivot]
+            packet ^= self.packet_vector[pivot]
+            pending ^= lowest
+        if coefficients == 0:
+            # not innovative, the rest of the state is left untouched
+            return False
+        bit = coefficients & -coefficients
+        new_pivot = bit.bit_length() - 1
+        # back-substitute the new pivot into the rows above it
+        for pivot in self.pivots:
+            if pivot > new_pivot:
+                break
+            if self.coefficient_matrix[pivot] & bit:
+                self.coefficient_matrix[pivot] ^= coefficients
+                self.packet_vector[pivot] ^= packet
+                self._check_decoded(pivot)
+        self.coefficient_matrix[new_pivot] = coefficients
+        self.packet_vector[new_pivot] = packet
+        bisect.insort(self.pivots, new_pivot)
+        self.pivot_mask |= bit
+        self.num_independent += 1
+        self._check_decoded(new_pivot)
+        return True
+
+    def _check_decoded(self, pivot):
+        if not self.symbol_decoded[pivot] and self.coefficient_matrix[pivot] == 1 << pivot:
+            self.symbol_decoded[pivot] = True
+            self.num_decoded += 1
 
     def get_sys_coded_packet(self, index):
         """Returns an uncoded packet, if symbol was already decoded."""
         if self.is_symbol_decoded(index):
             coefficients = [0] * self.num_symbols
             coefficients[index] = 1
-            packet = self.packet_vector[index]
+            packet = unpack_bits(self.packet_vector[index], self.num_bit_packet)
         else:
             coefficients = None
             packet = None
@@ -80,43 +119,149 @@ class BinaryCoder(object):
 
     def get_new_coded_packet(self):
         """Select a random number of rows of the coefficient matrix and return the XOR of the associated packets and coefficients."""
-        coefficients = [0] * self.num_symbols
-        packet = [0] * self.num_bit_packet
+        coefficients = 0
+        packet = 0
         
         # "lazy-ensure" that coefficient vector is not all zeros (equal to empty information)
-        while sum(coefficients) == 0:
+        while coefficients == 0:
             random_num = self.random.randint(0,self.num_independent)
-            random_decisions = self.random.choices(range(self.num_independent), k=random_num)
-            coefficients = [0] * self.num_symbols
-            selected_coefficients = [self.coefficient_matrix[selected][0:self.num_symbols] for selected in random_decisions]
-            coefficients = [sum(x)%2 for x in zip(*selected_coefficients)] # elementwise addition of each selected coefficient
+            random_decisions = self.random.choices(self.pivots, k=random_num)
+            coefficients = 0
+            for selected in random_decisions:
+                coefficients ^= self.coefficient_matrix[selected]
 
         # add selected rows' payloads to packet
-        for l in range(self.num_bit_packet):
-            packet[l] = sum([self.packet_vector[selected][l] for selected in random_decisions])%2
+        for selected in random_decisions:
+            packet ^= self.packet_vector[selected]
 
-        return coefficients, packet
+        return unpack_coefficients(coefficients, self.num_symbols), unpack_bits(packet, self.num_bit_packet)
     
-    def get_generated_coded_packet(self):
-        packet = [0] * self.num_bit_packet
+    def get_generated_coded_packet(self, packed=False):
+        packet = 0
         
-        _, random_decisions = self.generate_coefficients()
+        coefficients = self.generate_packed_coefficients()
         
-        # add selected rows' payloads to packet
-        for l in range(self.num_bit_packet):
-            packet[l] = sum([self.packet_vector[selected][l] for selected in random_decisions])%2
+        # add selected rows' payloads to packet, rows chosen an even number of times cancel out
+        while coefficients:
+            lowest = coefficients & -coefficients
+            packet ^= self.packet_vector[lowest.bit_length() - 1]
+            coefficients ^= lowest
 
-        return packet
+        if packed:
+            return packet
+        return unpack_bits(packet, self.num_bit_packet)
     
+    # Byte oriented interface
+    # Blocks are bytes, bytearray or memoryview objects holding the packet bits in order, padded with zeros at the end
+
+    def _block_to_packet(self, block):
+        return int.from_bytes(block, "big") >> (self.num_byte_packet * 8 - self.num_bit_packet)
+
+    def _packet_to_block(self, packet):
+        return (packet << (self.num_byte_packet * 8 - self.num_bit_packet)).to_bytes(self.num_byte_packet, "big")
+
+    def consume_block(self, coefficients, block):
+        """Processes an encoded block of bytes together with its coefficients."""
+        return self.consume_packet(coefficients, self._block_to_packet(block))
+
+    def get_decoded_block(self, index):
+        """Returns the symbol as bytes if already decoded, otherwise returns None."""
+        block = None
+        if self.is_symbol_decoded(index):
+            block = self._packet_to_block(self.packet_vector[index])
+        return block
+
+    def get_decoded_payload(self):
+        """Returns all symbols concatenated as bytes, symbols which are not decoded yet are left as zeros."""
+        empty = bytes(self.num_byte_packet)
+        return b"".join(self._packet_to_block(self.packet_vector[index]) if decoded else empty for index, decoded in enumerate(self.symbol_decoded))
+
+    def get_generated_coded_block(self):
+        """Returns the next generated coded packet as bytes."""
+        return self._packet_to_block(self.get_generated_coded_packet(packed=True))
+
+    def encode(self, data, count):
+        """Loads data as the source symbols and returns the next count generated coded blocks as one bytes object.
+
+        Work is shared across symbols with the method of four Russians:
+        the XOR of every subset of each group of 8 rows is tabulated once,
+        so each coded block costs one lookup per 8 source symbols.
+        """
+        self._load_systematic(data)
+        tables = []
+        for start in range(0, self.num_symbols, 8):
+            rows = self.packet_vector[start:start + 8]
+            table = [0] * (1 << len(rows))
+            for subset in range(1, len(table)):
+                lowest = subset & -subset
+                table[subset] = table[subset ^ lowest] ^ rows[lowest.bit_length() - 1]
+            tables.append(table)
+        num_bytes = len(tables)
+        output = []
+        for coefficients in self.generate_packed_coefficients_batch(count):
+            packet = 0
+            for table, subset in zip(tables, coefficients.to_bytes(num_bytes, "little")):
+                packet ^= table[subset]
+            output.append(self._packet_to_block(packet))
+        return b"".join(output)
+
+    def _load_systematic(self, data):
+        """Replaces the state with data split into num_symbols uncoded blocks, zero padded at the end."""
+        self.reset()
+        size = self.num_byte_packet
+        data = bytes(data).ljust(self.num_symbols * size, b"\0")
+        for index in range(self.num_symbols):
+            self.coefficient_matrix[index] = 1 << index
+            self.packet_vector[index] = self._block_to_packet(data[index * size:(index + 1) * size])
+        self.pivots = list(range(self.num_symbols))
+        self.pivot_mask = (1 << self.num_symbols) - 1
+        self.num_independent = self.num_decoded = self.num_symbols
+        self.symbol_decoded = [True] * self.num_symbols
+
     def generate_coefficients(self):
+        """Draws the next coefficient vector, returns it as a list together with the chosen symbol indices."""
         seed = self.random.randint(0, 65535)
-        rng = random.Random()
-        rng.seed(seed)
-        coefficients = [0] * self.num_symbols
-
-        while sum(coefficients) == 0:
-            n = rng.randint(0, self.num_symbols)
-            chosen = rng.choices(range(self.num_symbols), k=n)
-            generated_coefficients = [[0 if i != index else 1 for i in range(self.num_symbols)] for index in chosen]
-            coefficients = [sum(x) % 2 for x in zip(*generated_coefficients)]
-        return coefficients, chosen
+        chosen, coefficients = draw_coefficients(seed, self.num_symbols)
+        return unpack_coefficients(coefficients, self.num_symbols), chosen
+
+    def generate_packed_coefficients(self):
+        """Draws the next coefficient vector bit-packed, advancing the stream exactly like generate_coefficients."""
+        return packed_coefficients(self.random.randint(0, 65535), self.num_symbols)
+
+    def generate_packed_coefficients_batch(self, k):
+        """Draws the next k coefficient vectors bit-packed."""
+        return [packed_coefficients(self.random.randint(0, 65535), self.num_symbols) for _ in range(k)]
+
+
+def draw_coefficients(seed, num_symbols):
+    """Replays the coefficient draw for a seed, returns the chosen symbol indices and the bit-packed coefficients.
+
+    Chosen indices are XORed in directly, instead of summing one-hot vectors, so a draw is O(n).
+    """
+    rng = random.Random()
+    rng.seed(seed)
+    coefficients = 0
+
+    while coefficients == 0:
+        n = rng.randint(0, num_symbols)
+        chosen = rng.choices(range(num_symbols), k=n)
+        for index in chosen:
+            coefficients ^= 1 << index
+    return chosen, coefficients
+
+
+# Coefficient vectors are only cached up to this many symbols, so the cache holds at most 65536 vectors of 128 bytes.
+# Larger generations, e.g. files coded as a single generation of bytes, draw them every time.
+MAX_CACHED_SYMBOLS = 1024
+
+
+def packed_coefficients(seed, num_symbols):
+    """Bit-packed coefficients for a seed, cached for small generations, there are only 65536 seeds for each number of symbols."""
+    if num_symbols > MAX_CACHED_SYMBOLS:
+        return draw_coefficients(seed, num_symbols)[1]
+    return _cached_coefficients(seed, num_symbols)
+
+
+@functools.lru_cache(maxsize=65536)
+def _cached_coefficients(seed, num_symbols):
+    return draw_coefficients(seed, num_symbols)[1]
@@ -0,0 +1,134 @@
+import bisect
+import random
+from .gf256_utilities import gf_add_scaled, gf_inv, gf_scale
+
+
+class GF256Coder(object):
+    """ Network Coding class allowing for operations on GF(2^8).
+
+    Symbols are blocks of symbol_size bytes and every coefficient is a whole byte,
+    so random combinations are innovative far more often than over the binary field.
+    Rows are kept as bytes, scaled with precomputed multiplication tables through bytes.translate
+    and added with a single XOR.
+    """
+
+    def __init__(self, num_symbols, symbol_size, rng_seed):
+        self.num_symbols = num_symbols
+        self.symbol_size = symbol_size
+        self.random = random.Random()
+        self.random.seed(rng_seed)
+        self.seed = rng_seed
+        self.reset()
+
+    def reset(self):
+        self.num_independent = 0
+        self.num_decoded = 0
+        self.symbol_decoded = [False] * self.num_symbols
+        # current rref, with the row whose leading one is in column k stored at index k
+        self.coefficient_matrix = [bytes(self.num_symbols)] * self.num_symbols
+        self.packet_vector = [bytes(self.symbol_size)] * self.num_symbols
+        self.pivots = [] # sorted columns holding a leading one
+
+    def is_symbol_decoded(self, index):
+        """Returns the decoding status for a given symbol at index."""
+        return self.symbol_decoded[index]
+
+    def get_decoded_symbol(self, index):
+        """Returns the symbol if already decoded, otherwise returns None."""
+        symbol = None
+        if self.is_symbol_decoded(index):
+            symbol = self.packet_vector[index]
+        return symbol
+
+    def get_num_decoded(self):
+        return self.num_decoded
+
+    def is_fully_decoded(self):
+        """Returns true, if all symbols are decoded."""
+        return self.num_decoded == self.num_symbols
+
+    def rank(self):
+        """Returns current rank of the coefficient matrix."""
+        return self.num_independent
+
+    def consume_packet(self, coefficients, packet):
+        """Processes an encoded symbol together with its coefficients.
+
+        Returns true, if the packet was innovative.
+        """
+        if self.is_fully_decoded():
+            return False
+        coefficients = bytes(coefficients)
+        packet = bytes(packet)
+        # reduce the new row against the pivots we already have
+        for pivot in self.pivots:
+            factor = coefficients[pivot]
+            if factor:
+                coefficients = gf_add_scaled(coefficients, self.coefficient_matrix[pivot], factor)
+                packet = gf_add_scaled(packet, self.packet_vector[pivot], factor)
+        new_pivot = next((column for column, value in enumerate(coefficients) if value), None)
+        if new_pivot is None:
+            # not innovative, the rest of the state is left untouched
+            return False
+        # normalise the leading coefficient to one
+        inverse = gf_inv(coefficients[new_pivot])
+        coefficients = gf_scale(coefficients, inverse)
+        packet = gf_scale(packet, inverse)
+        # back-substitute the new pivot into the rows above it
+        for pivot in self.pivots:
+            if pivot > new_pivot:
+                break
+            factor = self.coefficient_matrix[pivot][new_pivot]
+            if factor:
+                self.coefficient_matrix[pivot] = gf_add_scaled(self.coefficient_matrix[pivot], coefficients, factor)
+                self.packet_vector[pivot] = gf_add_scaled(self.packet_vector[pivot], packet, factor)
+                self._check_decoded(pivot)
+        self.coefficient_matrix[new_pivot] = coefficients
+        self.packet_vector[new_pivot] = packet
+        bisect.insort(self.pivots, new_pivot)
+        self.num_independent += 1
+        self._check_decoded(new_pivot)
+        return True
+
+    def _check_decoded(self, pivot):
+        if not self.symbol_decoded[pivot] and self.coefficient_matrix[pivot].count(0) == self.num_symbols - 1:
+            self.symbol_decoded[pivot] = True
+            self.num_decoded += 1
+
+    def get_sys_coded_packet(self, index):
+        """Returns an uncoded packet, if symbol was already decoded."""
+        if self.is_symbol_decoded(index):
+            coefficients = bytearray(self.num_symbols)
+            coefficients[index] = 1
+            return bytes(coefficients), self.packet_vector[index]
+        return None, None
+
+    def get_new_coded_packet(self):
+        """Return a random linear combination of the rows of the coefficient matrix and their packets."""
+        coefficients = bytes(self.num_symbols)
+
+        # "lazy-ensure" that coefficient vector is not all zeros (equal to empty information)
+        while not any(coefficients):
+            factors = self.random.randbytes(self.num_independent)
+            coefficients = bytes(self.num_symbols)
+            packet = bytes(self.symbol_size)
+            for pivot, factor in zip(self.pivots, factors):
+                coefficients = gf_add_scaled(coefficients, self.coefficient_matrix[pivot], factor)
+                packet = gf_add_scaled(packet, self.packet_vector[pivot], factor)
+
+        return coefficients, packet
+
+    def get_generated_coded_packet(self):
+        """Returns the combination of the symbols with the next coefficients from generate_coefficients."""
+        coefficients = self.generate_coefficients()
+        packet = bytes(self.symbol_size)
+        for index, factor in enumerate(coefficients):
+            packet = gf_add_scaled(packet, self.packet_vector[index], factor)
+        return packet
+
+    def generate_coefficients(self):
+        """Draws the next non-zero coefficient vector, reproducible from the seed."""
+        coefficients = bytes(self.num_symbols)
+        while not any(coefficients):
+            coefficients = self.random.randbytes(self.num_symbols)
+        return coefficients
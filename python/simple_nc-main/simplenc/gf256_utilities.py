@@ -0,0 +1,59 @@
+
+PRIMITIVE_POLYNOMIAL = 0x11d # x^8 + x^4 + x^3 + x^2 + 1, with 2 as a generator
+
+
+def _build_tables():
+    """Builds the exponent and logarithm tables of GF(2^8)."""
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= PRIMITIVE_POLYNOMIAL
+    # duplicate the table so the sum of two logarithms never needs a modulo
+    for power in range(255, 512):
+        exp[power] = exp[power - 255]
+    return exp, log
+
+
+GF_EXP, GF_LOG = _build_tables()
+
+
+def gf_mul(a, b):
+    """Multiplies two elements of GF(2^8)."""
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    """Returns the multiplicative inverse of a non-zero element of GF(2^8)."""
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(2^8)")
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+# Row c of the table maps every element x to c * x, so that bytes.translate scales a whole row at once
+GF_MUL_TABLE = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+
+
+def gf_scale(row, c):
+    """Multiplies every element of a bytes row by c."""
+    return row.translate(GF_MUL_TABLE[c])
+
+
+def gf_add(a, b):
+    """Adds (XORs) two bytes rows of equal length."""
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def gf_add_scaled(a, b, c):
+    """Returns a + c * b for two bytes rows of equal length."""
+    if c == 0:
+        return a
+    if c == 1:
+        return gf_add(a, b)
+    return gf_add(a, gf_scale(b, c))
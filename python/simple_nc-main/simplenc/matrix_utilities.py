@@ -68,4 +68,30 @@ def bin_mat_dot(K, L):
 
 def identity(n):
     """Credits to user JLT: https://stackoverflow.com/questions/40269725/trying-to-construct-identity-matrix"""
-    return [[0] * i + [1] + [0] * (n-i-1) for i in range(n)]
\ No newline at end of file
+    return [[0] * i + [1] + [0] * (n-i-1) for i in range(n)]
+
+def pack_bits(bits):
+    """Packs a list of bits into an int, the first bit being the most significant."""
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bit
+    return value
+
+
+def unpack_bits(value, n):
+    """Unpacks an int into a list of n bits, the first bit being the most significant."""
+    return [value >> i & 1 for i in range(n - 1, -1, -1)]
+
+
+def pack_coefficients(coefficients):
+    """Packs a coefficient vector into an int, with coefficient i stored at bit i."""
+    value = 0
+    for index, coefficient in enumerate(coefficients):
+        if coefficient:
+            value |= 1 << index
+    return value
+
+
+def unpack_coefficients(value, n):
+    """Unpacks an int into a coefficient vector of length n, with coefficient i taken from bit i."""
+    return [value >> i & 1 for i in range(n)]
@@ -0,0 +1,196 @@
+import numpy as np
+from .binary_network_coder import BinaryCoder
+
+
+class NumpyBinaryCoder(BinaryCoder):
+    """ Network Coding class allowing for operations on binary field, backed by numpy.
+
+    The coefficient matrix and packet vector are np.uint8 arrays packed with np.packbits,
+    so that elimination and encoding run as vectorised XORs over whole rows.
+    Coefficients and packets are accepted and returned in the same forms as the BinaryCoder,
+    and coefficients are drawn from the same generator, so both coders are interchangeable.
+    """
+
+    NUM_D_TYPE = np.uint8 # The datatype of underlying numpy arrays
+
+    def reset(self):
+        self.num_independent = 0
+        self.num_decoded = 0
+        self.symbol_decoded = [False] * self.num_symbols
+        self.num_byte_coefficients = (self.num_symbols + 7) // 8
+        # current rref, with the row whose leading one is in column k stored at index k
+        # coefficient k is stored at bit k % 8 of byte k // 8, packets are stored in big-endian bit order
+        self.coefficient_matrix = np.zeros((self.num_symbols, self.num_byte_coefficients), dtype=self.NUM_D_TYPE)
+        self.packet_vector = np.zeros((self.num_symbols, self.num_byte_packet), dtype=self.NUM_D_TYPE)
+        self.is_pivot = np.zeros(self.num_symbols, dtype=bool)
+        self.pivots = []
+
+    def _coefficients_to_row(self, coefficients):
+        if isinstance(coefficients, int):
+            return np.frombuffer(coefficients.to_bytes(self.num_byte_coefficients, "little"), dtype=self.NUM_D_TYPE).copy()
+        return np.packbits(np.asarray(coefficients, dtype=self.NUM_D_TYPE), bitorder="little")
+
+    def _packet_to_row(self, packet):
+        if isinstance(packet, int):
+            padding = self.num_byte_packet * 8 - self.num_bit_packet
+            return np.frombuffer((packet << padding).to_bytes(self.num_byte_packet, "big"), dtype=self.NUM_D_TYPE).copy()
+        return np.packbits(np.asarray(packet, dtype=self.NUM_D_TYPE))
+
+    def _row_to_packet(self, row, packed):
+        if packed:
+            padding = self.num_byte_packet * 8 - self.num_bit_packet
+            return int.from_bytes(row.tobytes(), "big") >> padding
+        return np.unpackbits(row, count=self.num_bit_packet).tolist()
+
+    def _column(self, rows, column):
+        """Returns the bits of the given rows at a column of the coefficient matrix."""
+        return (self.coefficient_matrix[rows, column // 8] >> (column % 8)) & 1
+
+    def get_decoded_symbol(self, index, packed=False):
+        """Returns the symbol if already decoded, otherwise returns None."""
+        symbol = None
+        if self.is_symbol_decoded(index):
+            symbol = self._row_to_packet(self.packet_vector[index], packed)
+        return symbol
+
+    def consume_packet(self, coefficients, packet):
+        """Processes an encoded symbol together with its coefficients.
+
+        Returns true, if the packet was innovative.
+        """
+        if self.is_fully_decoded():
+            return False
+        return self._consume_row(self._coefficients_to_row(coefficients), self._packet_to_row(packet))
+
+    def consume_block(self, coefficients, block):
+        """Processes an encoded block of bytes together with its coefficients."""
+        if self.is_fully_decoded():
+            return False
+        return self._consume_row(self._coefficients_to_row(coefficients), np.frombuffer(block, dtype=self.NUM_D_TYPE).copy())
+
+    def _consume_row(self, coefficients, packet):
+        # reduce the new row against all pivots it touches at once
+        # pivot rows are zero in every other pivot column, so their XORs are independent of each other
+        bits = np.unpackbits(coefficients, count=self.num_symbols, bitorder="little").astype(bool)
+        selected = np.flatnonzero(bits & self.is_pivot)
+        if len(selected):
+            coefficients ^= np.bitwise_xor.reduce(self.coefficient_matrix[selected], axis=0)
+            packet ^= np.bitwise_xor.reduce(self.packet_vector[selected], axis=0)
+        remaining = np.flatnonzero(np.unpackbits(coefficients, count=self.num_symbols, bitorder="little"))
+        if len(remaining) == 0:
+            # not innovative, the rest of the state is left untouched
+            return False
+        new_pivot = int(remaining[0])
+        # back-substitute the new pivot into every row that has it set
+        if self.pivots:
+            pivots = np.array(self.pivots)
+            touched = pivots[self._column(pivots, new_pivot) == 1]
+            if len(touched):
+                self.coefficient_matrix[touched] ^= coefficients
+                self.packet_vector[touched] ^= packet
+                weights = np.unpackbits(self.coefficient_matrix[touched], axis=1).sum(axis=1)
+                for pivot in touched[weights == 1]:
+                    self._mark_decoded(int(pivot))
+        self.coefficient_matrix[new_pivot] = coefficients
+        self.packet_vector[new_pivot] = packet
+        self.is_pivot[new_pivot] = True
+        self.pivots.append(new_pivot)
+        self.pivots.sort()
+        self.num_independent += 1
+        if len(remaining) == 1:
+            self._mark_decoded(new_pivot)
+        return True
+
+    def _mark_decoded(self, pivot):
+        if not self.symbol_decoded[pivot]:
+            self.symbol_decoded[pivot] = True
+            self.num_decoded += 1
+
+    def get_sys_coded_packet(self, index):
+        """Returns an uncoded packet, if symbol was already decoded."""
+        if self.is_symbol_decoded(index):
+            coefficients = [0] * self.num_symbols
+            coefficients[index] = 1
+            packet = self._row_to_packet(self.packet_vector[index], False)
+        else:
+            coefficients = None
+            packet = None
+        return coefficients, packet
+
+    def get_new_coded_packet(self):
+        """Select a random number of rows of the coefficient matrix and return the XOR of the associated packets and coefficients."""
+        coefficients = np.zeros(self.num_byte_coefficients, dtype=self.NUM_D_TYPE)
+
+        # "lazy-ensure" that coefficient vector is not all zeros (equal to empty information)
+        while not coefficients.any():
+            random_num = self.random.randint(0,self.num_independent)
+            random_decisions = self.random.choices(self.pivots, k=random_num)
+            selected = self._chosen_rows(random_decisions)
+            coefficients = np.bitwise_xor.reduce(self.coefficient_matrix[selected], axis=0)
+
+        # add selected rows' payloads to packet
+        packet = np.bitwise_xor.reduce(self.packet_vector[selected], axis=0)
+
+        coefficients = np.unpackbits(coefficients, count=self.num_symbols, bitorder="little").tolist()
+        return coefficients, self._row_to_packet(packet, False)
+
+    def get_generated_coded_packet(self, packed=False):
+        selected = self._selected_rows(self.generate_packed_coefficients())
+
+        # add selected rows' payloads to packet
+        packet = np.bitwise_xor.reduce(self.packet_vector[selected], axis=0)
+
+        return self._row_to_packet(packet, packed)
+
+    def get_decoded_block(self, index):
+        """Returns the symbol as bytes if already decoded, otherwise returns None."""
+        block = None
+        if self.is_symbol_decoded(index):
+            block = self.packet_vector[index].tobytes()
+        return block
+
+    def get_decoded_payload(self):
+        """Returns all symbols concatenated as bytes, symbols which are not decoded yet are left as zeros."""
+        if self.is_fully_decoded():
+            return self.packet_vector.tobytes()
+        return np.where(np.array(self.symbol_decoded)[:, None], self.packet_vector, 0).astype(self.NUM_D_TYPE).tobytes()
+
+    def get_generated_coded_block(self):
+        """Returns the next generated coded packet as bytes."""
+        selected = self._selected_rows(self.generate_packed_coefficients())
+        return np.bitwise_xor.reduce(self.packet_vector[selected], axis=0).tobytes()
+
+    def encode(self, data, count):
+        """Loads data as the source symbols and returns the next count generated coded blocks as one bytes object.
+
+        All coded blocks are computed in one matrix product over GF(2).
+        """
+        self._load_systematic(data)
+        coefficients = b"".join(c.to_bytes(self.num_byte_coefficients, "little") for c in self.generate_packed_coefficients_batch(count))
+        coefficients = np.frombuffer(coefficients, dtype=self.NUM_D_TYPE).reshape(count, self.num_byte_coefficients)
+        coefficients = np.unpackbits(coefficients, axis=1, count=self.num_symbols, bitorder="little")
+        bits = np.unpackbits(self.packet_vector, axis=1)
+        # float32 is exact here as long as there are fewer than 2^24 symbols, and uses the fast matrix product
+        product = coefficients.astype(np.float32) @ bits.astype(np.float32)
+        return np.packbits(product.astype(np.int64) & 1, axis=1).astype(self.NUM_D_TYPE).tobytes()
+
+    def _load_systematic(self, data):
+        """Replaces the state with data split into num_symbols uncoded blocks, zero padded at the end."""
+        self.reset()
+        data = bytes(data).ljust(self.num_symbols * self.num_byte_packet, b"\0")
+        self.packet_vector = np.frombuffer(data, dtype=self.NUM_D_TYPE).reshape(self.num_symbols, self.num_byte_packet).copy()
+        self.coefficient_matrix = np.packbits(np.eye(self.num_symbols, dtype=self.NUM_D_TYPE), axis=1, bitorder="little")
+        self.is_pivot[:] = True
+        self.pivots = list(range(self.num_symbols))
+        self.num_independent = self.num_decoded = self.num_symbols
+        self.symbol_decoded = [True] * self.num_symbols
+
+    def _selected_rows(self, coefficients):
+        """Returns the rows set in bit-packed coefficients."""
+        row = self._coefficients_to_row(coefficients)
+        return np.flatnonzero(np.unpackbits(row, count=self.num_symbols, bitorder="little"))
+
+    def _chosen_rows(self, decisions):
+        """Returns the rows chosen an odd number of times, as choosing a row twice cancels out."""
+        counts = np.bincount(np.asarray(decisions, dtype=np.intp), minlength=self.num_symbols)
+        return np.flatnonzero(counts & 1)
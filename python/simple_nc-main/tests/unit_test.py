@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import random
 import unittest
 import simplenc
 
@@ -22,6 +23,13 @@ class TestMatrixOperators(unittest.TestCase):
             self.assertEqual(rank, test["solution_rank"])
             self.assertEqual(is_decoded, test["solution_is_decoded"])
 
+    def test_packing(self):
+        bits = [1, 0, 1, 1, 0, 0, 0, 1]
+        self.assertEqual(simplenc.pack_bits(bits), 0b10110001)
+        self.assertEqual(simplenc.unpack_bits(0b10110001, 8), bits)
+        self.assertEqual(simplenc.pack_coefficients(bits), 0b10001101)
+        self.assertEqual(simplenc.unpack_coefficients(0b10001101, 8), bits)
+
     def test_identity(self):
         test = self.get_identity_test_cases()
         self.assertEqual(simplenc.identity(
@@ -100,6 +108,115 @@ class TestBinaryCoder(unittest.TestCase):
             # Check encoder and decoder states
             self.assertEqual(decoder.packet_vector,encoder.packet_vector)
 
+    def test_packed_coding(self):
+        num_symbols = 16
+        num_bits_packet = 32
+        rng = random.Random(1)
+        data = [rng.getrandbits(num_bits_packet) for _ in range(num_symbols)]
+        encoder = simplenc.BinaryCoder(num_symbols, num_bits_packet, 1)
+        for index, packet in enumerate(data):
+            encoder.consume_packet(1 << index, packet)
+        self.assertTrue(encoder.is_fully_decoded())
+
+        decoder = simplenc.BinaryCoder(num_symbols, num_bits_packet, 1)
+        while not decoder.is_fully_decoded():
+            coefficients, _ = decoder.generate_coefficients()
+            decoder.consume_packet(coefficients, encoder.get_generated_coded_packet(packed=True))
+        self.assertEqual([decoder.get_decoded_symbol(k, packed=True) for k in range(num_symbols)], data)
+        self.assertEqual(decoder.get_decoded_symbol(0), simplenc.unpack_bits(data[0], num_bits_packet))
+
+    def test_coefficient_stream(self):
+        num_symbols = 12
+        reference = random.Random(3)
+        coder = simplenc.BinaryCoder(num_symbols, 8, 3)
+        for _ in range(50):
+            # the original draw, summing one-hot vectors of the chosen indices
+            rng = random.Random(reference.randint(0, 65535))
+            expected = [0] * num_symbols
+            while sum(expected) == 0:
+                n = rng.randint(0, num_symbols)
+                chosen = rng.choices(range(num_symbols), k=n)
+                expected = [sum(x) % 2 for x in zip(*[[0 if i != index else 1 for i in range(num_symbols)] for index in chosen])]
+            self.assertEqual(coder.generate_coefficients(), (expected, chosen))
+
+        packed = simplenc.BinaryCoder(num_symbols, 8, 3)
+        batched = simplenc.BinaryCoder(num_symbols, 8, 3)
+        listed = simplenc.BinaryCoder(num_symbols, 8, 3)
+        batch = batched.generate_packed_coefficients_batch(20)
+        self.assertEqual([packed.generate_packed_coefficients() for _ in range(20)], batch)
+        self.assertEqual([simplenc.pack_coefficients(listed.generate_coefficients()[0]) for _ in range(20)], batch)
+
+    def test_coefficient_cache_bound(self):
+        cache = simplenc.binary_network_coder._cached_coefficients
+        num_symbols = simplenc.MAX_CACHED_SYMBOLS + 1
+        before = cache.cache_info().currsize
+        for seed in range(5):
+            self.assertEqual(simplenc.packed_coefficients(seed, num_symbols), simplenc.draw_coefficients(seed, num_symbols)[1])
+        self.assertEqual(cache.cache_info().currsize, before)
+        self.assertEqual(simplenc.packed_coefficients(7, 12), simplenc.draw_coefficients(7, 12)[1])
+
+    def test_block_coding(self):
+        for coder in self.get_coders():
+            num_symbols = 8
+            rng = random.Random(1)
+            payload = rng.randbytes(num_symbols * 4)
+            encoder = coder(num_symbols, 32, 1)
+            view = memoryview(payload)
+            for index in range(num_symbols):
+                encoder.consume_block(1 << index, view[index * 4:(index + 1) * 4])
+            self.assertEqual(encoder.get_decoded_payload(), payload)
+
+            decoder = coder(num_symbols, 32, 1)
+            self.assertEqual(decoder.get_decoded_payload(), bytes(len(payload)))
+            while not decoder.is_fully_decoded():
+                coefficients, _ = decoder.generate_coefficients()
+                decoder.consume_block(coefficients, bytearray(encoder.get_generated_coded_block()))
+            self.assertEqual(decoder.get_decoded_block(1), payload[4:8])
+            self.assertEqual(decoder.get_decoded_payload(), payload)
+
+            # blocks are padded with zeros at the end when the packet size is not a multiple of 8
+            partial = coder(2, 12, 1)
+            partial.consume_block(1 << 0, bytes([0xab, 0xc0]))
+            self.assertEqual(partial.get_decoded_symbol(0, packed=True), 0xabc)
+            self.assertEqual(partial.get_decoded_payload(), bytes([0xab, 0xc0, 0, 0]))
+
+    def test_batch_encoding(self):
+        for coder in self.get_coders():
+            for num_symbols, num_bits_packet in [(1, 8), (5, 16), (8, 32), (20, 64)]:
+                size = num_bits_packet // 8
+                # the last block is short and gets zero padded
+                data = random.Random(num_symbols).randbytes(num_symbols * size - 1)
+                encoder = coder(num_symbols, num_bits_packet, 1)
+                for index in range(num_symbols):
+                    encoder.consume_block(1 << index, data[index * size:(index + 1) * size].ljust(size, b"\0"))
+                expected = b"".join(encoder.get_generated_coded_block() for _ in range(num_symbols * 2))
+                batch = coder(num_symbols, num_bits_packet, 1)
+                self.assertEqual(batch.encode(data, num_symbols * 2), expected)
+                self.assertTrue(batch.is_fully_decoded())
+
+    def get_coders(self):
+        coders = [simplenc.BinaryCoder]
+        if hasattr(simplenc, "NumpyBinaryCoder"):
+            coders.append(simplenc.NumpyBinaryCoder)
+        return coders
+
+    def test_incremental_decoding(self):
+        decoder = simplenc.BinaryCoder(3, 3, 1)
+        self.assertTrue(decoder.consume_packet([0, 1, 1], [1, 1, 0]))
+        self.assertTrue(decoder.consume_packet([0, 0, 1], [1, 0, 1]))
+        # only the second symbol is decoded, and it is stored at its own index
+        self.assertEqual(decoder.symbol_decoded, [False, True, True])
+        self.assertEqual(decoder.get_decoded_symbol(1), [0, 1, 1])
+        self.assertEqual(decoder.get_decoded_symbol(2), [1, 0, 1])
+        # a packet in the span of the previous ones is rejected without changing the state
+        coefficient_matrix = list(decoder.coefficient_matrix)
+        self.assertFalse(decoder.consume_packet([0, 1, 0], [0, 1, 1]))
+        self.assertEqual(decoder.coefficient_matrix, coefficient_matrix)
+        self.assertEqual(decoder.rank(), 2)
+        self.assertTrue(decoder.consume_packet([1, 1, 1], [0, 0, 0]))
+        self.assertTrue(decoder.is_fully_decoded())
+        self.assertEqual(decoder.get_decoded_symbol(0), [1, 1, 0])
+        self.assertFalse(decoder.consume_packet([1, 0, 0], [1, 1, 0]))
 
     def get_coding_test_cases(self):
         tests = []
@@ -139,3 +256,104 @@ class TestBinaryCoder(unittest.TestCase):
                       "solution_first_sys_encoded_packet": (None, None),
                       "solution_is_fully_decoded": False})
         return tests
+
+
+@unittest.skipUnless(hasattr(simplenc, "NumpyBinaryCoder"), "numpy is not installed")
+class TestNumpyBinaryCoder(unittest.TestCase):
+    """Tests the NumpyBinaryCoder against the BinaryCoder."""
+
+    def setUp(self):
+        pass
+
+    def test_coding(self):
+        for num_symbols, num_bits_packet in [(1, 1), (3, 5), (9, 8), (16, 20)]:
+            rng_seed = 1
+            rng = random.Random(num_symbols)
+            data = [rng.getrandbits(num_bits_packet) for _ in range(num_symbols)]
+            encoders = [simplenc.BinaryCoder(num_symbols, num_bits_packet, rng_seed), simplenc.NumpyBinaryCoder(num_symbols, num_bits_packet, rng_seed)]
+            for encoder in encoders:
+                for index, packet in enumerate(data):
+                    encoder.consume_packet(1 << index, packet)
+                self.assertTrue(encoder.is_fully_decoded())
+            packets = [[encoder.get_generated_coded_packet() for _ in range(num_symbols * 2)] for encoder in encoders]
+            self.assertEqual(packets[0], packets[1])
+
+            decoder = simplenc.NumpyBinaryCoder(num_symbols, num_bits_packet, rng_seed)
+            for packet in packets[1]:
+                coefficients, _ = decoder.generate_coefficients()
+                decoder.consume_packet(coefficients, packet)
+            reference = simplenc.BinaryCoder(num_symbols, num_bits_packet, rng_seed)
+            for packet in packets[0]:
+                coefficients, _ = reference.generate_coefficients()
+                reference.consume_packet(coefficients, packet)
+            self.assertEqual(decoder.rank(), reference.rank())
+            self.assertEqual(decoder.symbol_decoded, reference.symbol_decoded)
+            for index in range(num_symbols):
+                self.assertEqual(decoder.get_decoded_symbol(index, packed=True), reference.get_decoded_symbol(index, packed=True))
+
+    def test_incremental_decoding(self):
+        decoder = simplenc.NumpyBinaryCoder(3, 3, 1)
+        self.assertTrue(decoder.consume_packet([0, 1, 1], [1, 1, 0]))
+        self.assertTrue(decoder.consume_packet([0, 0, 1], [1, 0, 1]))
+        self.assertEqual(decoder.symbol_decoded, [False, True, True])
+        self.assertEqual(decoder.get_decoded_symbol(1), [0, 1, 1])
+        self.assertFalse(decoder.consume_packet([0, 1, 0], [0, 1, 1]))
+        self.assertTrue(decoder.consume_packet([1, 1, 1], [0, 0, 0]))
+        self.assertTrue(decoder.is_fully_decoded())
+        self.assertEqual(decoder.get_decoded_symbol(0), [1, 1, 0])
+
+
+class TestGF256Coder(unittest.TestCase):
+    """Tests the GF256Coder and its field arithmetic."""
+
+    def setUp(self):
+        pass
+
+    def test_field(self):
+        for a in range(1, 256):
+            self.assertEqual(simplenc.gf_mul(a, simplenc.gf_inv(a)), 1)
+            self.assertEqual(simplenc.gf_mul(a, 1), a)
+            self.assertEqual(simplenc.gf_mul(a, 0), 0)
+        self.assertEqual(simplenc.gf_mul(0x53, 0xca), 0x8f)
+        self.assertEqual(simplenc.gf_scale(bytes([1, 2, 0]), 3), bytes([3, 6, 0]))
+        self.assertEqual(simplenc.gf_add_scaled(bytes([1, 2]), bytes([1, 1]), 2), bytes([3, 0]))
+
+    def test_coding(self):
+        num_symbols = 16
+        symbol_size = 32
+        rng = random.Random(1)
+        data = [rng.randbytes(symbol_size) for _ in range(num_symbols)]
+        encoder = simplenc.GF256Coder(num_symbols, symbol_size, 1)
+        for index, packet in enumerate(data):
+            coefficients = bytearray(num_symbols)
+            coefficients[index] = 1
+            encoder.consume_packet(coefficients, packet)
+        self.assertTrue(encoder.is_fully_decoded())
+        self.assertEqual(encoder.get_sys_coded_packet(0), (bytes([1]) + bytes(num_symbols - 1), data[0]))
+
+        decoder = simplenc.GF256Coder(num_symbols, symbol_size, 1)
+        necessary_messages = 0
+        while not decoder.is_fully_decoded():
+            coefficients = decoder.generate_coefficients()
+            decoder.consume_packet(coefficients, encoder.get_generated_coded_packet())
+            necessary_messages += 1
+        self.assertEqual([decoder.get_decoded_symbol(k) for k in range(num_symbols)], data)
+        self.assertLessEqual(necessary_messages, num_symbols + 2)
+
+        recoder = simplenc.GF256Coder(num_symbols, symbol_size, 2)
+        while not recoder.is_fully_decoded():
+            recoder.consume_packet(*decoder.get_new_coded_packet())
+        self.assertEqual(recoder.packet_vector, decoder.packet_vector)
+
+    def test_incremental_decoding(self):
+        decoder = simplenc.GF256Coder(3, 2, 1)
+        self.assertTrue(decoder.consume_packet([0, 2, 4], [6, 8]))
+        self.assertTrue(decoder.consume_packet([0, 0, 3], [3, 6]))
+        self.assertEqual(decoder.symbol_decoded, [False, True, True])
+        self.assertEqual(decoder.get_decoded_symbol(1), bytes([1, 0]))
+        self.assertEqual(decoder.get_decoded_symbol(2), bytes([1, 2]))
+        self.assertFalse(decoder.consume_packet([0, 5, 5], simplenc.gf_scale(bytes([0, 2]), 5)))
+        self.assertEqual(decoder.rank(), 2)
+        self.assertTrue(decoder.consume_packet([1, 1, 1], [0, 0]))
+        self.assertTrue(decoder.is_fully_decoded())
+        self.assertEqual(decoder.get_decoded_symbol(0), bytes([0, 2]))
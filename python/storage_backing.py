@@ -1,11 +1,23 @@
+import copy
+import io
 import os
 import shutil
+import tempfile
 
-from simplenc import BinaryCoder
+import storage_cache
+import storage_coding
+import storage_database
+import storage_locks
+import storage_plans
 
 from constants import *
 from storage_metadata import *
 
+# new files get the default mode, which only the umask tells, and reading it means setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
 def ensure(directory: str):
 	if not os.path.exists(directory):
 		os.mkdir(directory)
@@ -15,6 +27,8 @@ def ensure(directory: str):
 
 
 def ls(path: str):
+	if METADATA_BACKEND == "sqlite":
+		return storage_database.ls(path)
 	if os.name == "posix":
 		if not path.startswith("/"):
 			path = "/" + path
@@ -36,10 +50,10 @@ def stats(path: str):
 		if not path.startswith("/"):
 			path = "/" + path
 		metadata = load_metadata(path)
-		return metadata.length, metadata.ctime_ns, metadata.mtime_ns, metadata.atime_ns
+		return metadata.length, metadata.ctime_ns, metadata.mtime_ns, metadata.atime_ns, metadata.generation_size, metadata.symbol_size, metadata.redundancy
 	if os.name == "nt":
 		metadata = load_metadata(path)
-		return metadata.length, metadata.ctime_ns, metadata.mtime_ns, metadata.atime_ns
+		return metadata.length, metadata.ctime_ns, metadata.mtime_ns, metadata.atime_ns, metadata.generation_size, metadata.symbol_size, metadata.redundancy
 
 
 def time(path: str, ctime: int, mtime: int, atime: int):
@@ -72,6 +86,7 @@ def create(path: str, directory: bool, seed: int = None, **kwargs):
 		symbol_path = SYMBOL_DIRECTORY + path
 		mode = kwargs["mode"] if "mode" in kwargs else None
 		if directory:
+			add_directory_metadata(path)
 			if mode:
 				os.mkdir(metadata_path, mode)
 				return os.mkdir(symbol_path, mode), None
@@ -92,6 +107,7 @@ def create(path: str, directory: bool, seed: int = None, **kwargs):
 				return fh, metadata.seed
 	if os.name == "nt":
 		if directory:
+			add_directory_metadata(path)
 			os.mkdir(os.path.join(METADATA_DIRECTORY, path))
 			os.mkdir(os.path.join(SYMBOL_DIRECTORY, path))
 		else:
@@ -104,84 +120,253 @@ def create(path: str, directory: bool, seed: int = None, **kwargs):
 
 
 
-def read_file(path: str, skip: int, equations: int, **kwargs) -> tuple[int, list[int]]:
-	if os.name == "posix":
-		if not path.startswith("/"):
-			path = "/" + path
-		metadata = load_metadata(path)
-		metadata.update_atime()
-		write_metadata(path, metadata)
-		with open(SYMBOL_DIRECTORY + path, "rb") as file:
-			symbols = file.read()
-		symbols = list(symbols)
-		return metadata.seed, symbols[skip:skip + equations]
-	if os.name == "nt":
-		metadata = load_metadata(path)
-		metadata.update_atime()
-		write_metadata(path, metadata)
-		with open(os.path.join(SYMBOL_DIRECTORY, path), "rb") as file:
-			symbols = file.read()
-		symbols = list(symbols)
-		return metadata.seed, symbols[skip:skip + equations]
+def read_symbols(path: str, skip: int, equations: int) -> memoryview:
+	"""Reads exactly the stored symbols [skip, skip + equations) of a symbol file"""
+	with open(path, "rb") as file:
+		equations = max(0, min(equations, os.fstat(file.fileno()).st_size - skip))
+		if os.name == "posix":
+			return memoryview(os.pread(file.fileno(), equations, skip))
+		if os.name == "nt":
+			buffer = bytearray(equations)
+			file.seek(skip)
+			return memoryview(buffer)[:file.readinto(buffer)]
+
+
+def read_file(path: str, skip: int, equations: int, **kwargs) -> tuple[int, memoryview]:
+	with storage_locks.reading(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			metadata = load_metadata(path)
+			if metadata.access():
+				write_metadata(path, metadata)
+			return metadata.seed, read_symbols(SYMBOL_DIRECTORY + path, skip, equations)
+		if os.name == "nt":
+			metadata = load_metadata(path)
+			if metadata.access():
+				write_metadata(path, metadata)
+			return metadata.seed, read_symbols(os.path.join(SYMBOL_DIRECTORY, path), skip, equations)
+
+
+def read_data(path: str, offset: int = 0, length: int = None, prefetch: bool = False, **kwargs) -> tuple[bytes, int]:
+	"""Decodes [offset, offset + length) of a local file, or all of it without a length
+	Only the generations covering the range are read, each stopping as soon as it is fully decoded
+	A prefetch finds nothing in a file removed since it was queued, rather than creating its metadata again
+	Returns the contents and the number of symbols consumed"""
+	with storage_locks.reading(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			metadata = find_metadata(path) if prefetch else load_metadata(path)
+			if metadata is None:
+				return b"", 0
+			if metadata.access():
+				write_metadata(path, metadata)
+			if length is None:
+				length = metadata.length - offset
+			with open(SYMBOL_DIRECTORY + path, "rb") as file:
+				return storage_coding.stream_range(metadata, file, offset, length, path)
+		if os.name == "nt":
+			metadata = find_metadata(path) if prefetch else load_metadata(path)
+			if metadata is None:
+				return b"", 0
+			if metadata.access():
+				write_metadata(path, metadata)
+			if length is None:
+				length = metadata.length - offset
+			with open(os.path.join(SYMBOL_DIRECTORY, path), "rb") as file:
+				return storage_coding.stream_range(metadata, file, offset, length, path)
 
 
 def rename(path: str, new_path: str):
-	if os.name == "posix":
-		if not path.startswith("/"):
-			path = "/" + path
-		os.rename(METADATA_DIRECTORY + path, METADATA_DIRECTORY + new_path)
-		os.rename(SYMBOL_DIRECTORY + path, SYMBOL_DIRECTORY + new_path)
-	if os.name == "nt":
-		try:
-			os.rename(os.path.join(METADATA_DIRECTORY, path), os.path.join(METADATA_DIRECTORY, new_path))
-			os.rename(os.path.join(SYMBOL_DIRECTORY, path), os.path.join(SYMBOL_DIRECTORY, new_path))
-		except:
-			pass  # it's probably a directory
+	with storage_locks.writing(path, new_path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			storage_cache.invalidate(new_path)
+			rename_metadata(path, new_path)
+			os.rename(METADATA_DIRECTORY + path, METADATA_DIRECTORY + new_path)
+			os.rename(SYMBOL_DIRECTORY + path, SYMBOL_DIRECTORY + new_path)
+		if os.name == "nt":
+			storage_cache.invalidate(path)
+			storage_cache.invalidate(new_path)
+			rename_metadata(path, new_path)
+			try:
+				os.rename(os.path.join(METADATA_DIRECTORY, path), os.path.join(METADATA_DIRECTORY, new_path))
+				os.rename(os.path.join(SYMBOL_DIRECTORY, path), os.path.join(SYMBOL_DIRECTORY, new_path))
+			except:
+				pass  # it's probably a directory
 
 
-def write(path: str, start: int, length: int, data: bytes, **kwargs):
-	if os.name == "posix":
-		if not path.startswith("/"):
-			path = "/" + path
-		metadata = load_metadata(path)
-		metadata.length = length
-		metadata.update_mtime()
-		metadata.update_atime()
-		write_metadata(path, metadata)
-		encoder = BinaryCoder(length, 8, metadata.seed)
-		for i in range(length):
-			coefficients = [0] * length
-			coefficients[i] = 1
-			byte = data[i]
-			encoder.consume_packet(coefficients, [byte >> i & 1 for i in range(8 - 1, -1, -1)])
-		symbols = []
-		for _ in range(length * 2):
-			symbol = encoder.get_generated_coded_packet()
-			symbol = int("".join(map(str, symbol)), 2)
-			symbols.append(symbol)
-		symbols = bytes(symbols)
-		with open(SYMBOL_DIRECTORY + path, "wb") as file:
-			result = file.write(symbols)
-		return length if result == length * 2 else 0, metadata.seed
-	if os.name == "nt":
-		metadata = load_metadata(path)
-		metadata.length = length
-		metadata.update_mtime()
-		metadata.update_atime()
-		write_metadata(path, metadata)
-		encoder = BinaryCoder(length, 8, metadata.seed)
-		for i in range(length):
-			coefficients = [1 if j == i else 0 for j in range(length)]
-			encoder.consume_packet(coefficients, [1 if digit=='1' else 0 for digit in format(data[i], "08b")])
-		symbols = [0] * (length * 2)
-		for i in range(length * 2):
-			symbol = encoder.get_generated_coded_packet()
-			symbol = int("".join(map(str, symbol)), 2)
-			symbols[i] = symbol
-		symbols = bytes(symbols)
-		with open(os.path.join(SYMBOL_DIRECTORY, path), "wb") as file:
-			file.write(symbols)
-		return metadata.seed
+def open_symbols(path: str):
+	return open(path, "r+b" if os.path.exists(path) else "w+b")
+
+
+def replace_symbols(path: str, metadata: Metadata, source, redundancy: float, fsync: bool = False):
+	"""Encodes everything read from source into a new symbol file, which then atomically takes the place of path
+	metadata is only updated once the new symbols are in place, a failure leaves the old file and metadata as they were"""
+	directory, name = os.path.split(path)
+	descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+	replacement = copy.copy(metadata)
+	try:
+		with open(descriptor, "w+b") as file:
+			storage_coding.encode_stream(replacement, source, file, redundancy)
+			if fsync:
+				file.flush()
+				os.fsync(file.fileno())
+		# mkstemp creates files only the owner can access, keep the mode of the file being replaced
+		if os.path.exists(path):
+			shutil.copymode(path, temporary)
+		else:
+			os.chmod(temporary, 0o666 & ~UMASK)
+		os.replace(temporary, path)
+	except BaseException:
+		if os.path.exists(temporary):
+			os.unlink(temporary)
+		raise
+	vars(metadata).update(vars(replacement))
+
+
+def write(path: str, start: int, length: int, data: bytes, truncate: bool = False, fsync: bool = False, final_length: int = None, **kwargs):
+	"""Writes length bytes of data at start, re-encoding only the generations they touch
+	The file grows to fit, or with truncate ends right after the data, fsync makes the symbols and metadata durable
+	final_length is how long a file written in pieces will be, for picking its redundancy from the first piece"""
+	with storage_locks.writing(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			new_length = start + length if truncate else max(metadata.length, start + length)
+			# existing files keep their redundancy, rather than being converted on every partial write
+			redundancy = metadata.redundancy if metadata.length and not (truncate and start == 0) else storage_coding.choose_redundancy(path, final_length or new_length)
+			if truncate and start == 0:
+				replace_symbols(SYMBOL_DIRECTORY + path, metadata, io.BytesIO(data[:length]), redundancy, fsync)
+			else:
+				with open_symbols(SYMBOL_DIRECTORY + path) as file:
+					storage_coding.write_range(metadata, file, start, data[:length], new_length, redundancy)
+					if fsync:
+						file.flush()
+						os.fsync(file.fileno())
+			metadata.update_mtime()
+			metadata.update_atime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return length, metadata.seed
+		if os.name == "nt":
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			new_length = start + length if truncate else max(metadata.length, start + length)
+			# existing files keep their redundancy, rather than being converted on every partial write
+			redundancy = metadata.redundancy if metadata.length and not (truncate and start == 0) else storage_coding.choose_redundancy(path, final_length or new_length)
+			if truncate and start == 0:
+				replace_symbols(os.path.join(SYMBOL_DIRECTORY, path), metadata, io.BytesIO(data[:length]), redundancy, fsync)
+			else:
+				with open_symbols(os.path.join(SYMBOL_DIRECTORY, path)) as file:
+					storage_coding.write_range(metadata, file, start, data[:length], new_length, redundancy)
+					if fsync:
+						file.flush()
+						os.fsync(file.fileno())
+			metadata.update_mtime()
+			metadata.update_atime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return metadata.seed
+
+
+def convert(path: str, redundancy: float, fsync: bool = False, **kwargs):
+	"""Re-encodes a whole file at another redundancy, decoding it a generation at a time"""
+	with storage_locks.writing(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			with open(SYMBOL_DIRECTORY + path, "rb") as file:
+				replace_symbols(SYMBOL_DIRECTORY + path, metadata, storage_coding.RangeReader(copy.copy(metadata), file), redundancy, fsync)
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+		if os.name == "nt":
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			with open(os.path.join(SYMBOL_DIRECTORY, path), "rb") as file:
+				replace_symbols(os.path.join(SYMBOL_DIRECTORY, path), metadata, storage_coding.RangeReader(copy.copy(metadata), file), redundancy, fsync)
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+
+
+def truncate(path: str, length: int, fsync: bool = False, **kwargs):
+	"""Sets the length of a file, dropping the generations past the end or leaving new ones as holes
+	Only the generation the file now ends in is re-encoded"""
+	with storage_locks.writing(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			with open_symbols(SYMBOL_DIRECTORY + path) as file:
+				storage_coding.write_range(metadata, file, length, b"", length)
+				if fsync:
+					file.flush()
+					os.fsync(file.fileno())
+			metadata.update_mtime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return metadata.seed
+		if os.name == "nt":
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			with open_symbols(os.path.join(SYMBOL_DIRECTORY, path)) as file:
+				storage_coding.write_range(metadata, file, length, b"", length)
+				if fsync:
+					file.flush()
+					os.fsync(file.fileno())
+			metadata.update_mtime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return metadata.seed
+
+
+def source_length(source) -> int:
+	"""Length of a source file when it can be told up front, for picking its redundancy"""
+	try:
+		return os.fstat(source.fileno()).st_size
+	except (AttributeError, OSError, ValueError):
+		return 0
+
+
+def write_stream(path: str, source, fsync: bool = False, **kwargs):
+	"""Replaces a file with everything read from source, encoding it a generation at a time in bounded memory"""
+	with storage_locks.writing(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			replace_symbols(SYMBOL_DIRECTORY + path, metadata, source, storage_coding.choose_redundancy(path, source_length(source)), fsync)
+			metadata.update_mtime()
+			metadata.update_atime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return metadata.length, metadata.seed
+		if os.name == "nt":
+			storage_cache.invalidate(path)
+			metadata = load_metadata(path)
+			replace_symbols(os.path.join(SYMBOL_DIRECTORY, path), metadata, source, storage_coding.choose_redundancy(path, source_length(source)), fsync)
+			metadata.update_mtime()
+			metadata.update_atime()
+			write_metadata(path, metadata)
+			if fsync:
+				flush_metadata(path, fsync=True)
+			return metadata.seed
 
 
 def remove_path(path: str):
@@ -199,14 +384,30 @@ def remove_path(path: str):
 				os.remove(path)
 
 
+def forget_plans(path: str):
+	"""Deletes the decoding plans kept on disk for a file being removed, they can't be used by anything else"""
+	if not PLAN_CACHE_ON_DISK:
+		return
+	metadata = find_metadata(path)
+	if metadata is not None:
+		storage_plans.forget(storage_coding.plan_keys(metadata))
+
+
 def remove(path: str):
-	if os.name == "posix":
-		if not path.startswith("/"):
-			path = "/" + path
-		remove_path(METADATA_DIRECTORY + path)
-		remove_path(SYMBOL_DIRECTORY + path)
-	if os.name == "nt":
-		# TODO: figure out why directories are sticky (sometimes?)
-		remove_path(os.path.join(METADATA_DIRECTORY, path))
-		remove_path(os.path.join(SYMBOL_DIRECTORY, path))
+	with storage_locks.writing(path):
+		if os.name == "posix":
+			if not path.startswith("/"):
+				path = "/" + path
+			storage_cache.invalidate(path)
+			forget_plans(path)
+			remove_metadata(path)
+			remove_path(METADATA_DIRECTORY + path)
+			remove_path(SYMBOL_DIRECTORY + path)
+		if os.name == "nt":
+			# TODO: figure out why directories are sticky (sometimes?)
+			storage_cache.invalidate(path)
+			forget_plans(path)
+			remove_metadata(path)
+			remove_path(os.path.join(METADATA_DIRECTORY, path))
+			remove_path(os.path.join(SYMBOL_DIRECTORY, path))
 		
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+from constants import *
+from storage_metadata import Metadata
+
+# Decoded contents of recently read generations, so sequential reads of one file don't decode it again for every call
+# Entries are keyed by path, seed and mtime, so a rewritten file misses even before it is invalidated
+
+
+cache: OrderedDict[tuple[str, int, int, int], bytes] = OrderedDict()
+lock = threading.Lock()
+size = 0
+hits = 0
+misses = 0
+
+
+def key(path: str, metadata: Metadata, generation: int) -> tuple[str, int, int, int]:
+	return (path, metadata.seed, metadata.mtime_ns, generation)
+
+
+def get(path: str, metadata: Metadata, generation: int) -> bytes | None:
+	global hits, misses
+	with lock:
+		data = cache.get(key(path, metadata, generation))
+		if data is None:
+			misses += 1
+			return None
+		cache.move_to_end(key(path, metadata, generation))
+		hits += 1
+		return data
+
+
+def put(path: str, metadata: Metadata, generation: int, data: bytes):
+	global size
+	if len(data) > DATA_CACHE_BYTES:
+		return
+	with lock:
+		old = cache.pop(key(path, metadata, generation), None)
+		if old is not None:
+			size -= len(old)
+		cache[key(path, metadata, generation)] = data
+		size += len(data)
+		while size > DATA_CACHE_BYTES:
+			_, evicted = cache.popitem(last=False)
+			size -= len(evicted)
+
+
+def invalidate(path: str):
+	"""Drops everything cached for a path, or anything below it for a directory"""
+	global size
+	children = (path.rstrip("/\\") + "/", path.rstrip("/\\") + "\\")
+	with lock:
+		for entry in [entry for entry in cache if entry[0] == path or entry[0].startswith(children)]:
+			size -= len(cache.pop(entry))
+
+
+def clear():
+	global size
+	with lock:
+		cache.clear()
+		size = 0
+
+
+def stats() -> dict[str, int]:
+	with lock:
+		return {"hits": hits, "misses": misses, "entries": len(cache), "bytes": size}
@@ -0,0 +1,370 @@
+import copy
+import math
+
+try:
+	# vectorised coding when numpy is available, both coders produce the same symbols
+	from simplenc import NumpyBinaryCoder as BinaryCoder
+except ImportError:
+	from simplenc import BinaryCoder
+
+import storage_cache
+import storage_plans
+
+from constants import *
+from storage_metadata import Metadata
+
+# Files are split into generations of metadata.generation_size symbols of metadata.symbol_size bytes
+# Each generation is encoded independently into metadata.redundancy times as many coded symbols, stored back to back in the symbol file
+# Metadata without a generation size describes the original layout: one generation of single byte symbols
+# A short last generation is stored with however many more coded symbols it takes to reach full rank, so it always decodes
+# All zero coded symbols decode to all zero contents whatever the coefficients, so zero filled generations are never encoded:
+# they are left as holes in the symbol file until written
+
+
+def set_layout(metadata: Metadata, length: int):
+	metadata.length = length
+	metadata.generation_size = GENERATION_SIZE
+	metadata.symbol_size = SYMBOL_SIZE
+	metadata.generations = generation_count(metadata)
+
+
+def symbol_size(metadata: Metadata) -> int:
+	return metadata.symbol_size if metadata.generation_size else 1
+
+
+def generation_size(metadata: Metadata) -> int:
+	return metadata.generation_size if metadata.generation_size else max(metadata.length, 1)
+
+
+def symbol_count(metadata: Metadata) -> int:
+	return -(-metadata.length // symbol_size(metadata))
+
+
+def generation_count(metadata: Metadata) -> int:
+	return -(-symbol_count(metadata) // generation_size(metadata))
+
+
+def generation_symbols(metadata: Metadata, generation: int) -> int:
+	"""Number of source symbols in a generation, only the last one may be short"""
+	return min(generation_size(metadata), symbol_count(metadata) - generation * generation_size(metadata))
+
+
+def generation_length(metadata: Metadata, generation: int) -> int:
+	"""Number of file bytes in a generation"""
+	start = generation * generation_size(metadata) * symbol_size(metadata)
+	return min(generation_size(metadata) * symbol_size(metadata), metadata.length - start)
+
+
+def coded_count(metadata: Metadata, symbols: int) -> int:
+	"""Number of coded symbols stored for a generation of this many source symbols, never fewer"""
+	return max(symbols, math.ceil(round(symbols * metadata.redundancy, 6)))
+
+
+def coded_symbols(metadata: Metadata, generation: int) -> int:
+	symbols = generation_symbols(metadata, generation)
+	count = coded_count(metadata, symbols)
+	if metadata.generation_size and symbols < metadata.generation_size:
+		# few source symbols are often rank deficient at the usual redundancy, nothing is stored after the last generation so it can grow
+		return storage_plans.decodable(generation_seed(metadata, generation), symbols, count)
+	return count
+
+
+def generation_offset(metadata: Metadata, generation: int) -> int:
+	"""Byte offset of a generation's coded symbols in the symbol file"""
+	return generation * coded_count(metadata, generation_size(metadata)) * symbol_size(metadata)
+
+
+def choose_redundancy(path: str, length: int) -> float:
+	"""Redundancy for a file being written from scratch, by directory then by size"""
+	path = "/" + path.replace("\\", "/").lstrip("/")
+	directories = [directory for directory in REDUNDANCY_DIRECTORIES if path.startswith(directory.rstrip("/") + "/")]
+	sizes = [(minimum, redundancy) for minimum, redundancy in REDUNDANCY_BY_SIZE if length >= minimum]
+	if directories:
+		redundancy = REDUNDANCY_DIRECTORIES[max(directories, key=len)]
+	elif sizes:
+		redundancy = max(sizes)[1]
+	else:
+		redundancy = REDUNDANCY
+	return check_redundancy(redundancy)
+
+
+def check_redundancy(redundancy: float) -> float:
+	"""Rejects redundancy that can't be decoded, and raises it so full generations get at least MIN_EXTRA_SYMBOLS extra coded symbols
+	Each extra symbol about halves the chance a generation is rank deficient, at no extra symbols it usually is"""
+	if redundancy <= 1.0:
+		raise ValueError(f"redundancy {redundancy} must be more than 1.0")
+	return max(redundancy, 1 + MIN_EXTRA_SYMBOLS / GENERATION_SIZE)
+
+
+def stored_size(metadata: Metadata) -> int:
+	"""Size of the whole symbol file in bytes"""
+	generations = generation_count(metadata)
+	if generations == 0:
+		return 0
+	return generation_offset(metadata, generations - 1) + coded_symbols(metadata, generations - 1) * symbol_size(metadata)
+
+
+def requested_size(metadata: Metadata) -> int:
+	"""Symbol file bytes to ask a peer for, whose seed and so short last generation may differ from metadata's
+	Peers only send the symbols they have, so this leaves room for another generation"""
+	return stored_size(metadata) + generation_offset(metadata, 1)
+
+
+def generation_seed(metadata: Metadata, generation: int) -> int:
+	return metadata.seed + generation
+
+
+def encode_generation(metadata: Metadata, generation: int, data: bytes) -> bytes:
+	"""Encodes the file bytes of one generation into its coded symbols"""
+	size = symbol_size(metadata)
+	symbols = generation_symbols(metadata, generation)
+	encoder = BinaryCoder(symbols, size * 8, generation_seed(metadata, generation))
+	return encoder.encode(data, coded_symbols(metadata, generation))
+
+
+def encode(metadata: Metadata, data: bytes) -> bytes:
+	output = bytearray()
+	span = generation_size(metadata) * symbol_size(metadata)
+	for generation in range(generation_count(metadata)):
+		output += encode_generation(metadata, generation, data[generation * span:(generation + 1) * span])
+	return bytes(output)
+
+
+def read_fully(source, size: int) -> bytes:
+	"""Reads up to size bytes, only returning short at the end of source"""
+	data = source.read(size)
+	while data and len(data) < size:
+		more = source.read(size - len(data))
+		if not more:
+			break
+		data += more
+	return data
+
+
+def encode_stream(metadata: Metadata, source, file, redundancy: float = REDUNDANCY):
+	"""Encodes everything read from source into an open symbol file, one generation at a time
+	Only a generation of the source is held in memory, so the length doesn't need to be known up front"""
+	metadata.redundancy = redundancy
+	set_layout(metadata, 0)
+	span = GENERATION_SIZE * SYMBOL_SIZE
+	generation = 0
+	while True:
+		data = read_fully(source, span)
+		if not data:
+			break
+		set_layout(metadata, generation * span + len(data))
+		file.seek(generation_offset(metadata, generation))
+		file.write(encode_generation(metadata, generation, data))
+		generation += 1
+		if len(data) < span:
+			break
+	file.truncate(stored_size(metadata))
+
+
+def same_layout(metadata: Metadata, redundancy: float) -> bool:
+	"""Whether a file's symbols are laid out as they would be written now, so generations can be rewritten in place"""
+	return metadata.generation_size == GENERATION_SIZE and metadata.symbol_size == SYMBOL_SIZE and metadata.redundancy == redundancy
+
+
+def write_range(metadata: Metadata, file, start: int, data: bytes, length: int, redundancy: float = None):
+	"""Writes data at start into an open symbol file, leaving the file length bytes long
+	Only generations whose contents change are decoded and re-encoded, the rest of the symbol file is untouched
+	metadata describes the file before the write, and is updated to describe it after
+	Changing the redundancy of a file that has contents converts it whole"""
+	if redundancy is None:
+		redundancy = metadata.redundancy
+	old = copy.copy(metadata)
+	end = start + len(data)
+	span = GENERATION_SIZE * SYMBOL_SIZE
+	if length == 0:
+		# nothing is kept, so whatever the old layout was there is nothing to decode
+		metadata.redundancy = redundancy
+		set_layout(metadata, 0)
+		file.seek(0)
+		file.truncate(0)
+		return
+	if old.length and not same_layout(old, redundancy):
+		# files in another layout are converted whole
+		contents = bytearray(stream(old, file)[0])
+		contents[start:end] = data
+		contents = bytes(contents[:length]).ljust(length, b"\0")
+		metadata.redundancy = redundancy
+		set_layout(metadata, length)
+		file.seek(0)
+		file.write(encode(metadata, contents))
+		file.truncate(stored_size(metadata))
+		return
+	metadata.redundancy = redundancy
+	set_layout(metadata, length)
+	changed = set(generation_range(metadata, start, len(data)))
+	if length > old.length and old.length % span:
+		# the old last generation gains symbols, generations after it start out as holes
+		changed.add(old.length // span)
+	if length < old.length and length % span:
+		changed.add(length // span)
+	data = memoryview(data)
+	for generation in sorted(changed):
+		first = generation * span
+		contents = bytearray(stream_generation(old, generation, file)[0] if first < old.length else b"")
+		contents = contents[:generation_length(metadata, generation)]
+		contents += bytes(generation_length(metadata, generation) - len(contents))
+		overlap_start = max(start, first)
+		overlap_end = min(end, first + len(contents))
+		if overlap_start < overlap_end:
+			contents[overlap_start - first:overlap_end - first] = data[overlap_start - start:overlap_end - start]
+		file.seek(generation_offset(metadata, generation))
+		file.write(encode_generation(metadata, generation, contents))
+	file.truncate(stored_size(metadata))
+
+
+class RangeReader:
+	"""Reads a file's contents from its open symbol file like a file object, decoding only the generations read
+	The symbol file is closed once the end is read, so it can be replaced right after"""
+
+	def __init__(self, metadata: Metadata, file):
+		self.metadata = metadata
+		self.file = file
+		self.position = 0
+
+	def read(self, size: int = -1) -> bytes:
+		if size < 0:
+			size = self.metadata.length - self.position
+		data, _ = stream_range(self.metadata, self.file, self.position, size)
+		self.position += len(data)
+		if len(data) < size:
+			self.file.close()
+		return data
+
+
+class GenerationDecoder:
+	"""Decodes one generation from its coded symbols, in the order they are stored"""
+
+	def __init__(self, metadata: Metadata, generation: int):
+		self.generation = generation
+		self.size = symbol_size(metadata)
+		self.length = generation_length(metadata, generation)
+		self.num_symbols = generation_symbols(metadata, generation)
+		self.decoder = BinaryCoder(self.num_symbols, self.size * 8, generation_seed(metadata, generation))
+
+	def consume(self, symbol: bytes) -> bool:
+		coefficient = self.decoder.generate_packed_coefficients()
+		return self.decoder.consume_block(coefficient, symbol)
+
+	def is_fully_decoded(self) -> bool:
+		return self.decoder.is_fully_decoded()
+
+	def rank(self) -> int:
+		return self.decoder.rank()
+
+	def data(self) -> bytes:
+		return self.decoder.get_decoded_payload()[:self.length]
+
+
+def decode_generation(metadata: Metadata, generation: int, symbols: bytes) -> bytes:
+	"""Decodes one generation from (a prefix of) its coded symbols"""
+	decoder = GenerationDecoder(metadata, generation)
+	for i in range(0, len(symbols) - decoder.size + 1, decoder.size):
+		decoder.consume(symbols[i:i + decoder.size])
+	return decoder.data()
+
+
+def decode(metadata: Metadata, symbols: bytes) -> bytes:
+	output = bytearray()
+	for generation in range(generation_count(metadata)):
+		start = generation_offset(metadata, generation)
+		end = start + coded_symbols(metadata, generation) * symbol_size(metadata)
+		output += decode_generation(metadata, generation, symbols[start:end])
+	return bytes(output)
+
+
+def stream_generation(metadata: Metadata, generation: int, file) -> tuple[bytes, int]:
+	"""Decodes one generation from an open symbol file, reading only the symbols needed for full rank
+	Returns the decoded bytes and the number of symbols consumed"""
+	size = symbol_size(metadata)
+	plan = storage_plans.get(generation_seed(metadata, generation), generation_symbols(metadata, generation), coded_symbols(metadata, generation))
+	file.seek(generation_offset(metadata, generation))
+	symbols = file.read(plan.used * size)
+	if len(symbols) < plan.used * size:
+		# symbol file is shorter than the metadata says, decode whatever is there
+		return decode_generation(metadata, generation, symbols), len(symbols) // size
+	return storage_plans.apply(plan, symbols, size)[:generation_length(metadata, generation)], plan.used
+
+
+def plan_keys(metadata: Metadata) -> list[tuple[int, int, int]]:
+	"""Keys of the decoding plans a file's generations use"""
+	return [(generation_seed(metadata, generation), generation_symbols(metadata, generation), coded_symbols(metadata, generation)) for generation in range(generation_count(metadata))]
+
+
+def generation_range(metadata: Metadata, offset: int, length: int) -> range:
+	"""Generations covering the file bytes [offset, offset + length)"""
+	span = generation_size(metadata) * symbol_size(metadata)
+	end = min(offset + length, metadata.length)
+	if end <= offset:
+		return range(0)
+	return range(offset // span, -(-end // span))
+
+
+def stream_range(metadata: Metadata, file, offset: int, length: int, path: str = None) -> tuple[bytes, int]:
+	"""Decodes only the generations covering [offset, offset + length) from an open symbol file
+	Generations are looked up in and added to the decoded content cache when a path is given
+	Returns those bytes and the number of symbols consumed"""
+	span = generation_size(metadata) * symbol_size(metadata)
+	generations = generation_range(metadata, offset, length)
+	output = bytearray()
+	consumed = 0
+	for generation in generations:
+		data = storage_cache.get(path, metadata, generation) if path is not None else None
+		if data is None:
+			data, used = stream_generation(metadata, generation, file)
+			consumed += used
+			if path is not None:
+				storage_cache.put(path, metadata, generation, data)
+		output += data
+	if not generations:
+		return b"", consumed
+	start = offset - generations.start * span
+	return bytes(output[start:start + length]), consumed
+
+
+def stream(metadata: Metadata, file) -> tuple[bytes, int]:
+	"""Decodes a whole file from an open symbol file, returns the contents and the number of symbols consumed"""
+	output = bytearray()
+	consumed = 0
+	for generation in range(generation_count(metadata)):
+		data, used = stream_generation(metadata, generation, file)
+		output += data
+		consumed += used
+	return bytes(output), consumed
+
+
+class FileDecoder:
+	"""Decodes a whole file from its symbol file, fed incrementally in stored order, e.g. as it arrives over the network"""
+
+	def __init__(self, metadata: Metadata):
+		self.metadata = metadata
+		self.seed = metadata.seed
+		self.length = metadata.length
+		self.reset()
+
+	def reset(self):
+		self.position = 0
+		self.pending = bytearray()
+		self.decoders = [GenerationDecoder(self.metadata, generation) for generation in range(generation_count(self.metadata))]
+
+	def consume(self, symbols: bytes):
+		size = symbol_size(self.metadata)
+		stride = generation_offset(self.metadata, 1)
+		end = stored_size(self.metadata)
+		self.pending += symbols
+		consumed = 0
+		while len(self.pending) - consumed >= size and self.position < end:
+			self.decoders[self.position // stride].consume(self.pending[consumed:consumed + size])
+			consumed += size
+			self.position += size
+		del self.pending[:consumed]
+
+	def is_fully_decoded(self) -> bool:
+		return all(decoder.is_fully_decoded() for decoder in self.decoders)
+
+	def data(self) -> bytes:
+		return b"".join(decoder.data() for decoder in self.decoders)
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+
+from constants import *
+
+# Optional metadata backend, enabled with METADATA_BACKEND = "sqlite"
+# Every path's metadata is a row in one WAL mode database, indexed by path and by parent directory
+# so listing a directory or reading a file's stats is a single indexed lookup instead of a JSON parse per entry
+# Paths are keyed the same way as storage_metadata: "/a/b" on posix, "a\b" on nt
+
+FIELDS = ["length", "seed", "ctime_ns", "mtime_ns", "atime_ns", "generation_size", "symbol_size", "generations", "redundancy"]
+COLUMNS = {field: "INTEGER NOT NULL DEFAULT 0" for field in FIELDS} | {"redundancy": "REAL NOT NULL DEFAULT 2.0"}
+
+local = threading.local()
+
+
+def connect() -> sqlite3.Connection:
+	"""One connection per thread, sqlite connections can't be shared between threads"""
+	connection = getattr(local, "connection", None)
+	if connection is None:
+		connection = sqlite3.connect(METADATA_DATABASE, timeout=30)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		connection.execute(f"""CREATE TABLE IF NOT EXISTS metadata (
+			path TEXT PRIMARY KEY,
+			parent TEXT NOT NULL,
+			name TEXT NOT NULL,
+			directory INTEGER NOT NULL DEFAULT 0,
+			{", ".join(f"{field} {COLUMNS[field]}" for field in FIELDS)}
+		)""")
+		# databases made before a field existed get its column added
+		existing = [row[1] for row in connection.execute("PRAGMA table_info(metadata)")]
+		for field in FIELDS:
+			if field not in existing:
+				connection.execute(f"ALTER TABLE metadata ADD COLUMN {field} {COLUMNS[field]}")
+		connection.execute("CREATE INDEX IF NOT EXISTS metadata_parent ON metadata (parent)")
+		connection.commit()
+		local.connection = connection
+	return connection
+
+
+def parent(path: str) -> str:
+	if os.name == "posix":
+		return os.path.dirname(path.rstrip("/")) or "/"
+	if os.name == "nt":
+		return os.path.dirname(path.rstrip("\\"))
+
+
+def directory_key(path: str) -> str:
+	if os.name == "posix":
+		if not path.startswith("/"):
+			path = "/" + path
+		return path.rstrip("/") or "/"
+	if os.name == "nt":
+		return path.rstrip("\\")
+
+
+def read(path: str) -> dict[str, int] | None:
+	row = connect().execute(f"SELECT {', '.join(FIELDS)} FROM metadata WHERE path = ? AND directory = 0", (path,)).fetchone()
+	if row is None:
+		return None
+	return dict(zip(FIELDS, row))
+
+
+def store_many(entries: list[tuple[str, dict[str, int]]], fsync: bool = False):
+	"""Upserts file metadata in one transaction"""
+	connection = connect()
+	with connection:
+		connection.executemany(
+			f"""INSERT INTO metadata (path, parent, name, {", ".join(FIELDS)}) VALUES (?, ?, ?, {", ".join("?" for _ in FIELDS)})
+			ON CONFLICT (path) DO UPDATE SET {", ".join(f"{field} = excluded.{field}" for field in FIELDS)}""",
+			[(path, parent(path), os.path.basename(path), *(data[field] for field in FIELDS)) for path, data in entries])
+	if fsync:
+		connection.execute("PRAGMA wal_checkpoint(FULL)")
+
+
+def store(path: str, data: dict[str, int], fsync: bool = False):
+	store_many([(path, data)], fsync)
+
+
+def add_directory(path: str):
+	path = directory_key(path)
+	connection = connect()
+	with connection:
+		connection.execute("INSERT OR IGNORE INTO metadata (path, parent, name, directory) VALUES (?, ?, ?, 1)", (path, parent(path), os.path.basename(path)))
+
+
+def children(path: str) -> tuple[int, str]:
+	"""Arguments for BELOW, matching everything below a path
+	Compared with substr rather than LIKE, which ignores ASCII case"""
+	separator = "/" if os.name == "posix" else "\\"
+	prefix = path.rstrip(separator) + separator
+	return len(prefix), prefix
+
+
+BELOW = "substr(path, 1, ?) = ?"
+
+
+def delete(path: str):
+	"""Deletes a path and, for a directory, everything below it"""
+	connection = connect()
+	with connection:
+		connection.execute(f"DELETE FROM metadata WHERE path = ? OR {BELOW}", (path, *children(path)))
+
+
+def rename(path: str, new_path: str):
+	"""Moves a path and, for a directory, everything below it"""
+	connection = connect()
+	with connection:
+		connection.execute(f"DELETE FROM metadata WHERE path = ? OR {BELOW}", (new_path, *children(new_path)))
+		rows = connection.execute(f"SELECT path FROM metadata WHERE path = ? OR {BELOW}", (path, *children(path))).fetchall()
+		for (old,) in rows:
+			moved = new_path + old[len(path):]
+			connection.execute("UPDATE metadata SET path = ?, parent = ?, name = ? WHERE path = ?", (moved, parent(moved), os.path.basename(moved), old))
+
+
+def ls(path: str) -> tuple[list[str], list[str]]:
+	rows = connect().execute("SELECT name, directory FROM metadata WHERE parent = ? ORDER BY name", (directory_key(path),)).fetchall()
+	folders = [name for name, directory in rows if directory]
+	files = [name for name, directory in rows if not directory]
+	return folders, files
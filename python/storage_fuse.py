@@ -1,22 +1,169 @@
+import contextlib
 import os
 import errno
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from fuse import FUSE, FuseOSError, Operations
 
-from simplenc import BinaryCoder
-from storage_metadata import load_metadata
-
 import storage_backing
+import storage_cache
+import storage_coding
 import storage_sync
 
 from constants import *
 from peer import *
+from storage_metadata import find_metadata, flush_metadata, from_ns, load_metadata, stop_flusher, write_metadata
+
+DEBUG = False
+
+
+class WriteBuffer:
+	"""Absorbs the writes to one open file, which are encoded and replicated together when flushed"""
+
+	def __init__(self, storage: "Storage", path: str):
+		self.storage = storage
+		self.path = path
+		self.extents: list[tuple[int, bytearray]] = []  # applied in order, so later writes win where they overlap
+		self.size = 0
+		self.lock = threading.RLock()
+		self.timer: threading.Timer = None
+		self.error: Exception = None
+		self.fresh = load_metadata(path).length == 0  # written from scratch, so its redundancy is picked again once its size is known
+
+	def add(self, offset: int, data: bytes) -> int:
+		with self.lock:
+			if self.extents:
+				start, extent = self.extents[-1]
+				if start <= offset <= start + len(extent):
+					# contiguous with or inside the last write, the usual sequential case
+					extent[offset - start:offset - start + len(data)] = data
+					self.size += len(data)
+					return self.size
+			self.extents.append((offset, bytearray(data)))
+			self.size += len(data)
+			if self.timer is None:
+				self.timer = threading.Timer(WRITE_BUFFER_DELAY, self.flush_later)
+				self.timer.daemon = True
+				self.timer.start()
+			return self.size
+
+	def flush(self, fsync: bool = False):
+		with self.lock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			if self.error is not None:
+				error, self.error = self.error, None
+				raise error
+			if not self.extents:
+				return
+			extents, self.extents, self.size = self.extents, [], 0
+			seed = None
+			for offset, data in extents:
+				_, seed = storage_backing.write(self.path, offset, len(data), data, fsync=fsync)
+			self.storage._invalidate(self.path)
+			if peer_list:
+				# peers only need the extents written, nothing is decoded to send them
+				length = load_metadata(self.path).length
+				for offset, data in extents:
+					storage_sync.write(self.path, seed, bytes(data), offset, length)
+
+	def flush_later(self):
+		with self.lock:
+			self.timer = None
+			try:
+				self.flush()
+			except Exception as error:
+				# reported by the next flush of the handle
+				if DEBUG: print(f"write back of {self.path} failed: {error}")
+				self.error = error
+
+
+readahead: ThreadPoolExecutor = None
+readahead_lock = threading.Lock()
+
+
+def readahead_executor() -> ThreadPoolExecutor:
+	global readahead
+	with readahead_lock:
+		if readahead is None:
+			readahead = ThreadPoolExecutor(max_workers=READAHEAD_THREADS, thread_name_prefix="readahead")
+		return readahead
+
+
+class ReadAhead:
+	"""Follows the reads of one open file, and decodes the generations after a sequential reader into the data cache"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self.end = 0  # where the next read starts if it is sequential
+		self.depth = 0  # generations decoded ahead, 0 until reads look sequential
+		self.pending: dict[int, Future] = {}
+		self.lock = threading.Lock()
+		self.closed = False
+
+	def wait(self, generations: range) -> bool:
+		"""Waits for generations being decoded ahead, returns whether the reader caught up with them"""
+		with self.lock:
+			futures = [self.pending[generation] for generation in generations if generation in self.pending]
+		caught_up = False
+		for future in futures:
+			if not future.done():
+				caught_up = True
+			try:
+				future.result()
+			except Exception:
+				pass  # the read itself will report it
+		return caught_up
+
+	def advance(self, offset: int, length: int, generations: range, span: int, count: int, caught_up: bool):
+		with self.lock:
+			sequential = offset == self.end
+			self.end = offset + length
+			for generation in [generation for generation in self.pending if generation < generations.start]:
+				del self.pending[generation]
+			if self.closed or not sequential:
+				self.depth = 0
+				return
+			missed = any(generation not in self.pending for generation in generations)
+			if caught_up or missed:
+				# the reader is outrunning the window, so widen it, from as much as it reads at once to READAHEAD_BYTES
+				self.depth = min(max(len(generations), self.depth * 2), max(len(generations), READAHEAD_BYTES // span))
+			for generation in range(generations.stop, min(generations.stop + self.depth, count)):
+				if generation not in self.pending:
+					self.pending[generation] = readahead_executor().submit(self.prefetch, generation)
+
+	def cancel(self):
+		"""Drops prefetches not started yet, e.g. once the file is closed or removed"""
+		with self.lock:
+			self.closed = True
+			for future in self.pending.values():
+				future.cancel()
+			self.pending.clear()
+
+	def prefetch(self, generation: int):
+		metadata = find_metadata(self.path)
+		if self.closed or metadata is None:
+			return
+		span = storage_coding.generation_size(metadata) * storage_coding.symbol_size(metadata)
+		storage_backing.read_data(self.path, generation * span, span, prefetch=True)
 
 
 class Storage(Operations):
 	def __init__(self, root):
 		self.root = root
 		self.handles: dict[int, str] = {}
+		self.buffers: dict[int, WriteBuffer] = {}
+		self.readaheads: dict[int, ReadAhead] = {}
+		self.handles_lock = threading.Lock()  # FUSE calls in from many threads at once
+		# getattr results by path, built from Metadata and kept for ATTR_TIMEOUT unless a change invalidates them first
+		# oldest first, expired entries and those past ATTR_CACHE_SIZE are dropped as new ones come in
+		self.attributes: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+		self.attributes_lock = threading.Lock()
 
 	# Helpers
 	# =======
@@ -27,6 +174,46 @@ class Storage(Operations):
 		path = os.path.join(self.root, path)
 		return path
 
+	def _flush_buffers(self, path, fsync=False):
+		"""Writes out what any handle has buffered for a path, so it is seen by other operations"""
+		with self.handles_lock:
+			buffers = [buffer for buffer in self.buffers.values() if buffer.path == path]
+		for buffer in buffers:
+			try:
+				buffer.flush(fsync)
+			except Exception:
+				raise FuseOSError(errno.EIO)
+
+	def _invalidate(self, *paths):
+		"""Drops cached attributes for paths and anything below them"""
+		with self.attributes_lock:
+			for path in paths:
+				children = path.rstrip("/") + "/"
+				for cached in [cached for cached in self.attributes if cached == path or cached.startswith(children)]:
+					del self.attributes[cached]
+
+	def _buffered_end(self, path):
+		with self.handles_lock:
+			buffers = [buffer for buffer in self.buffers.values() if buffer.path == path]
+		ends = []
+		for buffer in buffers:
+			with buffer.lock:
+				ends.extend(offset + len(data) for offset, data in buffer.extents)
+		return max(ends, default=0)
+
+	def _settle_redundancy(self, path):
+		"""Writes reach the backing in flushes, so a new file's redundancy was picked by the size of the first one
+		Picks it again by the whole file, converting the file if it changes"""
+		metadata = find_metadata(path)
+		if metadata is None or not metadata.length:
+			return
+		redundancy = storage_coding.choose_redundancy(path, metadata.length)
+		if redundancy != metadata.redundancy:
+			try:
+				storage_backing.convert(path, redundancy)
+			except Exception:
+				raise FuseOSError(errno.EIO)
+
 	# Filesystem methods
 	# ==================
 
@@ -37,17 +224,44 @@ class Storage(Operations):
 
 	def chmod(self, path, mode):
 		root_path = self._root_path(path)
+		self._invalidate(path)
 		return os.chmod(root_path, mode)
 
 	def chown(self, path, uid, gid):
 		root_path = self._root_path(path)
+		self._invalidate(path)
 		return os.chown(root_path, uid, gid)
 
 	def getattr(self, path, fh=None):
-		root_path = self._root_path(path)
-		st = os.lstat(root_path)
-		return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-					 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+		now = time.monotonic()
+		with self.attributes_lock:
+			cached = self.attributes.get(path)
+		if cached is not None and now - cached[0] < ATTR_TIMEOUT:
+			attributes = cached[1]
+		else:
+			root_path = self._root_path(path)
+			st = os.lstat(root_path)
+			attributes = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+						 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+			if stat.S_ISREG(st.st_mode):
+				# the entry under the root only holds metadata, the file itself is described by it
+				metadata = load_metadata(path)
+				attributes['st_size'] = metadata.length
+				attributes['st_atime'] = from_ns(metadata.atime_ns)
+				attributes['st_ctime'] = from_ns(metadata.ctime_ns)
+				attributes['st_mtime'] = from_ns(metadata.mtime_ns)
+			with self.attributes_lock:
+				self.attributes[path] = (now, attributes)
+				self.attributes.move_to_end(path)
+				while self.attributes:
+					oldest, (cached_at, _) = next(iter(self.attributes.items()))
+					if now - cached_at < ATTR_TIMEOUT and len(self.attributes) <= ATTR_CACHE_SIZE:
+						break
+					del self.attributes[oldest]
+		if self.buffers and stat.S_ISREG(attributes['st_mode']):
+			# writes still buffered by open handles already count towards the size
+			attributes = dict(attributes, st_size=max(attributes['st_size'], self._buffered_end(path)))
+		return attributes
 
 	def readdir(self, path, fh):
 		root_path = self._root_path(path)
@@ -70,11 +284,13 @@ class Storage(Operations):
 		return os.mknod(self._root_path(path), mode, dev)
 
 	def rmdir(self, path):
+		self._invalidate(path)
 		result = storage_backing.remove(path)
 		storage_sync.remove(path)
 		return result
 
 	def mkdir(self, path, mode):
+		self._invalidate(path)
 		result = storage_backing.create(path, True, mode=mode)
 		storage_sync.create(path, True)
 		return result
@@ -87,6 +303,15 @@ class Storage(Operations):
 			'f_frsize', 'f_namemax'))
 
 	def unlink(self, path):
+		with self.handles_lock:
+			buffers = [buffer for buffer in self.buffers.values() if buffer.path == path]
+			aheads = [ahead for ahead in self.readaheads.values() if ahead.path == path]
+		for buffer in buffers:
+			with buffer.lock:
+				buffer.extents, buffer.size = [], 0
+		for ahead in aheads:
+			ahead.cancel()
+		self._invalidate(path)
 		result = storage_backing.remove(path)
 		storage_sync.remove(path)
 		return result
@@ -95,7 +320,32 @@ class Storage(Operations):
 		return os.symlink(name, self._root_path(target))
 
 	def rename(self, old, new):
-		result = storage_backing.rename(old, new)
+		# handles open on the path or, for a directory, anything below it move with it
+		children = old.rstrip("/") + "/"
+
+		def moved(path):
+			return new + path[len(old):] if path == old or path.startswith(children) else path
+
+		with self.handles_lock:
+			buffers = [buffer for buffer in self.buffers.values() if moved(buffer.path) != buffer.path]
+		with contextlib.ExitStack() as stack:
+			# buffers moving are held until they have moved, so nothing is flushed to the old path after the rename
+			for buffer in buffers:
+				stack.enter_context(buffer.lock)
+				try:
+					buffer.flush()
+				except Exception:
+					raise FuseOSError(errno.EIO)
+			self._invalidate(old, new)
+			result = storage_backing.rename(old, new)
+			# only once the rename worked, a failed one leaves everything where it was
+			with self.handles_lock:
+				for buffer in self.buffers.values():
+					buffer.path = moved(buffer.path)
+				for ahead in self.readaheads.values():
+					ahead.path = moved(ahead.path)
+				for handle, path in self.handles.items():
+					self.handles[handle] = moved(path)
 		storage_sync.rename(old, new)
 		return result
 
@@ -103,6 +353,13 @@ class Storage(Operations):
 		return os.link(self._root_path(target), self._root_path(name))
 
 	def utimens(self, path, times=None):
+		self._invalidate(path)
+		if os.path.isfile(self._root_path(path)):
+			atime, mtime = times if times else (time.time(), time.time())
+			metadata = load_metadata(path)
+			metadata.atime_ns = int(atime * 1_000_000_000)
+			metadata.mtime_ns = int(mtime * 1_000_000_000)
+			write_metadata(path, metadata)
 		return os.utime(self._root_path(path), times)
 
 	# File methods
@@ -111,63 +368,106 @@ class Storage(Operations):
 	def open(self, path, flags):
 		root_path = self._root_path(path)
 		handle = os.open(root_path, flags)
-		self.handles[handle] = path
+		with self.handles_lock:
+			self.handles[handle] = path
 		return handle
 
 	def create(self, path, mode, fi=None):
+		self._invalidate(path)
 		result, seed = storage_backing.create(path, False, mode=mode)
 		storage_sync.create(path, False, seed)
-		self.handles[result] = path
+		with self.handles_lock:
+			self.handles[result] = path
 		return result
 
 	def read(self, path, length, offset, fh):
 		file_path = self.handles[fh]
+		self._flush_buffers(file_path)
+		with self.handles_lock:
+			if fh not in self.readaheads or self.readaheads[fh].path != file_path:
+				self.readaheads[fh] = ReadAhead(file_path)
+			ahead = self.readaheads[fh]
 		metadata = load_metadata(file_path)
-		seed, symbols = storage_backing.read_file(file_path, 0, metadata.length * 2, handle=fh)
-		output = bytearray(metadata.length)
-		decoder = BinaryCoder(metadata.length, 8, seed)
-		for symbol in symbols:
-			coefficient, _ = decoder.generate_coefficients()
-			decoder.consume_packet(coefficient, [1 if digit == "1" else 0 for digit in format(symbol, "08b")])
-		for i in range(metadata.length):
-			if decoder.is_symbol_decoded(i):
-				symbol = decoder.get_decoded_symbol(i)
-				output[i:i+1] = int("".join(map(str, symbol)), 2).to_bytes(1, "big")
-		contents = bytes(output)
+		generations = storage_coding.generation_range(metadata, offset, length)
+		caught_up = ahead.wait(generations)
+		contents, consumed = storage_backing.read_data(file_path, offset, length, handle=fh)
+		if DATA_CACHE_BYTES and READAHEAD_BYTES:
+			span = storage_coding.generation_size(metadata) * storage_coding.symbol_size(metadata)
+			ahead.advance(offset, len(contents), generations, span, storage_coding.generation_count(metadata), caught_up)
+		if DEBUG: print(f"read {file_path}: {len(contents)} bytes at {offset} from {consumed} symbols, readahead {ahead.depth}, cache {storage_cache.stats()}")
 		# TODO: get data from peers over network
 		# data = storage_sync.read(file_path, offset, length)
-		return contents[offset:offset + length]
+		return contents
 
 	def write(self, path, buf, offset, fh):
-		file_path = self.handles[fh]
-		result, seed = storage_backing.write(file_path, 0, len(buf), buf)
-		storage_sync.write(file_path, seed, buf)
-		return result
+		with self.handles_lock:
+			file_path = self.handles[fh]
+			if fh not in self.buffers:
+				self.buffers[fh] = WriteBuffer(self, file_path)
+			buffer = self.buffers[fh]
+		if buffer.add(offset, buf) >= WRITE_BUFFER_BYTES:
+			try:
+				buffer.flush()
+			except Exception:
+				raise FuseOSError(errno.EIO)
+		return len(buf)
 
 	def truncate(self, path, length, fh=None):
-		root_path = self._root_path(path)
-		with open(root_path, 'r+') as f:
-			f.truncate(length)
+		file_path = self.handles.get(fh, path)
+		self._flush_buffers(file_path)
+		self._invalidate(path)
+		seed = storage_backing.truncate(file_path, length)
+		if peer_list:
+			# an empty write at the new end sets the length on peers
+			storage_sync.write(file_path, seed, b"", length, length)
 
 	def flush(self, path, fh):
+		with self.handles_lock:
+			buffer = self.buffers.get(fh)
+		if buffer is not None:
+			try:
+				buffer.flush(fsync=True)
+			except Exception:
+				raise FuseOSError(errno.EIO)
 		return os.fsync(fh)
 
 	def release(self, path, fh):
-		del self.handles[fh]
-		return os.close(fh)
+		try:
+			self.flush(path, fh)
+			with self.handles_lock:
+				buffer = self.buffers.get(fh)
+			if buffer is not None and buffer.fresh:
+				self._settle_redundancy(buffer.path)
+		finally:
+			with self.handles_lock:
+				self.buffers.pop(fh, None)
+				ahead = self.readaheads.pop(fh, None)
+				self.handles.pop(fh, None)
+			if ahead is not None:
+				ahead.cancel()
+			os.close(fh)
 
 	def fsync(self, path, fdatasync, fh):
+		flush_metadata(self.handles.get(fh, path), fsync=True)
 		return self.flush(path, fh)
 
 def create():
 	destroy()
 	storage_backing.ensure(METADATA_DIRECTORY)
 	storage_backing.ensure(SYMBOL_DIRECTORY)
+	if PLAN_CACHE_ON_DISK:
+		storage_backing.ensure(PLAN_DIRECTORY)
 	storage_backing.ensure(MOUNT_POINT)
-	FUSE(Storage(METADATA_DIRECTORY), MOUNT_POINT, foreground=True)
+	FUSE(Storage(METADATA_DIRECTORY), MOUNT_POINT, foreground=True, nothreads=not FUSE_THREADS, attr_timeout=ATTR_TIMEOUT, entry_timeout=ENTRY_TIMEOUT)
 
 
 def destroy():
+	global readahead
+	with readahead_lock:
+		if readahead is not None:
+			readahead.shutdown(cancel_futures=True)
+			readahead = None
+	stop_flusher()
 	os.system(f"fusermount -u {MOUNT_POINT} > /dev/null 2>&1")
 	if os.path.exists(MOUNT_POINT):
 		os.rmdir(MOUNT_POINT)
@@ -0,0 +1,120 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from storage_metadata import metadata_key
+
+# Readers and writers of a path's symbols and metadata are kept apart by a lock per path
+# Reads of the same file run in parallel, and operations on different files never wait for each other
+# Locks only exist while they are held or waited on
+# Directories above a path are locked for reading too, so a directory being renamed or removed has nothing going on below it
+
+
+class ReadWriteLock:
+	"""Many readers or one writer, waiting writers hold off new readers so they aren't starved"""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.readers = 0
+		self.writer = False
+		self.waiting = 0
+
+	def acquire_read(self):
+		with self.condition:
+			while self.writer or self.waiting:
+				self.condition.wait()
+			self.readers += 1
+
+	def release_read(self):
+		with self.condition:
+			self.readers -= 1
+			if self.readers == 0:
+				self.condition.notify_all()
+
+	def acquire_write(self):
+		with self.condition:
+			self.waiting += 1
+			while self.writer or self.readers:
+				self.condition.wait()
+			self.waiting -= 1
+			self.writer = True
+
+	def release_write(self):
+		with self.condition:
+			self.writer = False
+			self.condition.notify_all()
+
+
+locks: dict[str, tuple[ReadWriteLock, int]] = {}
+table_lock = threading.Lock()
+
+
+def claim(path: str) -> ReadWriteLock:
+	with table_lock:
+		lock, users = locks.get(path, (None, 0))
+		if lock is None:
+			lock = ReadWriteLock()
+		locks[path] = (lock, users + 1)
+		return lock
+
+
+def unclaim(path: str):
+	with table_lock:
+		lock, users = locks[path]
+		if users == 1:
+			del locks[path]
+		else:
+			locks[path] = (lock, users - 1)
+
+
+def ancestors(path: str) -> list[str]:
+	"""Directories a path is below, not counting the root"""
+	separator = "/" if os.name == "posix" else "\\"
+	parts = path.strip(separator).split(separator)
+	prefix = separator if path.startswith(separator) else ""
+	return [prefix + separator.join(parts[:index]) for index in range(1, len(parts))]
+
+
+@contextmanager
+def locked(reads: list[str], writes: list[str]):
+	"""Locks paths for reading and writing, and the directories above them for reading
+	so renaming or removing a directory, which writes it, waits for everything below it and holds it off
+	Locks are always taken in the same order, so two callers can't deadlock"""
+	modes: dict[str, bool] = {}
+	for path in [metadata_key(path) for path in reads + writes]:
+		for directory in ancestors(path):
+			modes.setdefault(directory, False)
+	for path in reads:
+		modes.setdefault(metadata_key(path), False)
+	for path in writes:
+		modes[metadata_key(path)] = True
+	held = []
+	try:
+		for path in sorted(modes):
+			lock = claim(path)
+			try:
+				if modes[path]:
+					lock.acquire_write()
+				else:
+					lock.acquire_read()
+			except BaseException:
+				unclaim(path)
+				raise
+			held.append((path, lock))
+		yield
+	finally:
+		for path, lock in reversed(held):
+			if modes[path]:
+				lock.release_write()
+			else:
+				lock.release_read()
+			unclaim(path)
+
+
+def reading(path: str):
+	return locked([path], [])
+
+
+def writing(*paths: str):
+	"""Locks one or more paths for writing"""
+	return locked([], list(paths))
@@ -1,10 +1,15 @@
 from dataclasses import dataclass
+import copy
 import os
 import json
 import random
 import sys
 import jsons
+import threading
 import time
+from collections import OrderedDict
+
+import storage_database
 
 from constants import *
 
@@ -15,6 +20,10 @@ class Metadata:
 	ctime_ns: int = time.time_ns()
 	mtime_ns: int = time.time_ns()
 	atime_ns: int = time.time_ns()
+	generation_size: int = 0  # 0 for files written before generations, coded as a single generation
+	symbol_size: int = 1
+	generations: int = 0
+	redundancy: float = 2.0  # coded symbols stored per source symbol
 
 	def __init__(self) -> None:
 		self.seed = random.randint(0, sys.maxsize)
@@ -28,33 +37,230 @@ class Metadata:
 	def update_atime(self):
 		self.atime_ns = time.time_ns()
 
+	def access(self) -> bool:
+		"""Updates atime for a read as ATIME_MODE allows, returns whether it changed"""
+		if ATIME_MODE == "noatime":
+			return False
+		now = time.time_ns()
+		if ATIME_MODE == "relatime" and self.atime_ns > self.mtime_ns and self.atime_ns > self.ctime_ns and now - self.atime_ns < RELATIME_INTERVAL_NS:
+			return False
+		self.atime_ns = now
+		return True
 
-def load_metadata(path: str) -> Metadata:
-	metadata = Metadata()
+
+# Loaded metadata is kept in memory as live objects, shared by every caller for the same path
+# write_metadata only marks an entry dirty, a background thread writes dirty entries out every METADATA_FLUSH_INTERVAL
+# New files are still written through immediately, since the file tree under METADATA_DIRECTORY is the namespace
+# Clean entries are evicted least recently used first once there are more than METADATA_CACHE_SIZE, dirty ones stay until written
+metadata_cache: OrderedDict[str, Metadata] = OrderedDict()
+dirty: set[str] = set()
+metadata_lock = threading.RLock()
+flush_lock = threading.Lock()  # taken before metadata_lock, so entries aren't written out while they are being forgotten
+flusher: threading.Thread = None
+stop_flushing = threading.Event()
+
+
+def metadata_key(path: str) -> str:
 	if os.name == "posix":
 		if not path.startswith("/"):
 			path = "/" + path
-		if (os.path.exists(METADATA_DIRECTORY + path)):
-			with open(METADATA_DIRECTORY + path, "r") as file:
-				metadata = jsons.load(json.load(file), Metadata)
-		else:
-			write_metadata(path, metadata)
-	if os.name == "nt":
-		if os.path.exists(os.path.join(METADATA_DIRECTORY, path)):
-			with open(os.path.join(METADATA_DIRECTORY, path), "r") as file:
-				metadata = jsons.load(json.load(file), Metadata)
-		else:
-			write_metadata(path, metadata)
-	return metadata
+	return path
 
 
-def write_metadata(path: str, data: Metadata):
+def metadata_path(path: str) -> str:
 	if os.name == "posix":
-		with open(METADATA_DIRECTORY + path, "w") as file:
-			json.dump(jsons.dump(data, Metadata), file, indent=4)
+		return METADATA_DIRECTORY + path
 	if os.name == "nt":
-		with open(os.path.join(METADATA_DIRECTORY, path), "w") as file:
-			json.dump(jsons.dump(data, Metadata), file, indent=4)
+		return os.path.join(METADATA_DIRECTORY, path)
+
+
+def read_metadata(path: str) -> Metadata | None:
+	if METADATA_BACKEND == "sqlite":
+		fields = storage_database.read(path)
+		if fields is None:
+			return None
+		metadata = Metadata()
+		for field, value in fields.items():
+			setattr(metadata, field, value)
+		return metadata
+	return read_json_metadata(path)
+
+
+def read_json_metadata(path: str) -> Metadata | None:
+	if not os.path.exists(metadata_path(path)):
+		return None
+	with open(metadata_path(path), "r") as file:
+		return jsons.load(json.load(file), Metadata)
+
+
+def store_metadata(path: str, data: Metadata, fsync: bool = False):
+	return store_all_metadata([(path, data)], fsync)
+
+
+def store_all_metadata(entries: list[tuple[str, Metadata]], fsync: bool = False) -> list[tuple[str, Exception]]:
+	"""Writes out metadata, each entry on its own so one failure doesn't stop the rest, returns the entries that failed"""
+	failed = []
+	if METADATA_BACKEND == "sqlite":
+		try:
+			storage_database.store_many([(path, {field: getattr(data, field) for field in storage_database.FIELDS}) for path, data in entries], fsync)
+		except Exception as error:
+			failed = [(path, error) for path, _ in entries]
+		return failed
+	for path, data in entries:
+		try:
+			with open(metadata_path(path), "w") as file:
+				json.dump(jsons.dump(data, Metadata), file, indent=4)
+				if fsync:
+					file.flush()
+					os.fsync(file.fileno())
+		except OSError as error:
+			failed.append((path, error))
+	return failed
+
+
+def cache_metadata(path: str, metadata: Metadata):
+	"""Keeps metadata as the live entry for a path, evicting the least recently used clean entries past METADATA_CACHE_SIZE"""
+	with metadata_lock:
+		metadata_cache[path] = metadata
+		metadata_cache.move_to_end(path)
+		excess = len(metadata_cache) - METADATA_CACHE_SIZE
+		if excess > 0:
+			for entry in [entry for entry in metadata_cache if entry not in dirty and entry != path][:excess]:
+				del metadata_cache[entry]
+
+
+def load_metadata(path: str) -> Metadata:
+	path = metadata_key(path)
+	with metadata_lock:
+		if path in metadata_cache:
+			metadata_cache.move_to_end(path)
+			return metadata_cache[path]
+		metadata = read_metadata(path)
+		if metadata is None:
+			metadata = Metadata()
+			for _, error in store_metadata(path, metadata):
+				raise error
+			if METADATA_BACKEND == "sqlite":
+				# an empty placeholder still makes up the namespace for the mount
+				open(metadata_path(path), "a").close()
+		cache_metadata(path, metadata)
+		return metadata
+
+
+def find_metadata(path: str) -> Metadata | None:
+	"""Like load_metadata, but None for a path without metadata instead of creating it"""
+	path = metadata_key(path)
+	with metadata_lock:
+		if path in metadata_cache:
+			metadata_cache.move_to_end(path)
+			return metadata_cache[path]
+		metadata = read_metadata(path)
+		if metadata is not None:
+			cache_metadata(path, metadata)
+		return metadata
+
+
+def write_metadata(path: str, data: Metadata):
+	path = metadata_key(path)
+	if METADATA_FLUSH_INTERVAL <= 0:
+		with metadata_lock:
+			cache_metadata(path, data)
+			for _, error in store_metadata(path, data):
+				raise error
+		return
+	with metadata_lock:
+		dirty.add(path)
+		cache_metadata(path, data)
+	start_flusher()
+
+
+def flush_metadata(path: str = None, fsync: bool = METADATA_FSYNC):
+	"""Writes out dirty metadata, for one path and anything below it or for everything
+	Entries are copied under metadata_lock and written after releasing it, so lookups don't wait on the disk"""
+	with flush_lock:
+		with metadata_lock:
+			if path is None:
+				paths = list(dirty)
+			else:
+				path = metadata_key(path)
+				children = (path.rstrip("/\\") + "/", path.rstrip("/\\") + "\\")
+				paths = [entry for entry in dirty if entry == path or entry.startswith(children)]
+			dirty.difference_update(paths)
+			entries = [(entry, copy.copy(metadata_cache[entry])) for entry in paths]
+		# a directory renamed or removed above an entry takes its metadata with it, so there is nothing left to write
+		stale = [entry for entry, _ in entries if not os.path.isdir(os.path.dirname(metadata_path(entry)))]
+		failed = store_all_metadata([(entry, data) for entry, data in entries if entry not in stale], fsync)
+		with metadata_lock:
+			for entry in stale:
+				if entry not in dirty:
+					metadata_cache.pop(entry, None)
+			dirty.update(entry for entry, _ in failed if entry in metadata_cache)
+	for entry, error in failed:
+		print(f"couldn't write metadata for {entry}, will retry: {error}")
+	if failed and path is not None:
+		# an explicit flush, e.g. for fsync, has to report it
+		raise failed[0][1]
+
+
+def forget_metadata(path: str):
+	"""Drops cached metadata for a path and anything below it, without writing it out, e.g. before removing or renaming"""
+	path = metadata_key(path)
+	children = (path.rstrip("/\\") + "/", path.rstrip("/\\") + "\\")
+	with flush_lock, metadata_lock:
+		for entry in [entry for entry in metadata_cache if entry == path or entry.startswith(children)]:
+			del metadata_cache[entry]
+			dirty.discard(entry)
+
+
+def remove_metadata(path: str):
+	"""Drops a path's metadata, and anything below it, from the cache and the database"""
+	forget_metadata(path)
+	if METADATA_BACKEND == "sqlite":
+		storage_database.delete(metadata_key(path))
+
+
+def rename_metadata(path: str, new_path: str):
+	"""Writes out a path's metadata, and anything below it, before it moves"""
+	flush_metadata(path)
+	forget_metadata(path)
+	forget_metadata(new_path)
+	if METADATA_BACKEND == "sqlite":
+		storage_database.rename(metadata_key(path), metadata_key(new_path))
+
+
+def add_directory_metadata(path: str):
+	if METADATA_BACKEND == "sqlite":
+		storage_database.add_directory(metadata_key(path))
+
+
+def flush_loop():
+	while not stop_flushing.wait(METADATA_FLUSH_INTERVAL):
+		try:
+			flush_metadata()
+		except Exception as error:
+			# failed entries stay dirty, so the next round retries them
+			print(f"metadata flush failed: {error}")
+
+
+def start_flusher():
+	global flusher
+	with metadata_lock:
+		if flusher is None:
+			stop_flushing.clear()
+			flusher = threading.Thread(target=flush_loop, daemon=True)
+			flusher.start()
+
+
+def stop_flusher():
+	"""Stops the background flusher and writes out everything still dirty, call on shutdown"""
+	global flusher
+	with metadata_lock:
+		thread = flusher
+		flusher = None
+	if thread is not None:
+		stop_flushing.set()
+		thread.join()
+	flush_metadata(fsync=True)
 
 
 def from_ns(time):
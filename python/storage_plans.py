@@ -0,0 +1,179 @@
+import functools
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from simplenc import BinaryCoder
+
+from constants import *
+
+DEBUG = False
+
+# The coefficients of a generation only depend on its seed and symbol count, so neither does the inverse transformation
+# A decoding plan records, for every source symbol, which stored symbols XOR together into it
+# Repeat reads then skip Gaussian elimination entirely, and only read the symbols the plan uses
+
+
+@dataclass
+class DecodingPlan:
+	used: int  # stored symbols needed, the shortest prefix reaching full rank
+	rows: list[int]  # bitmask over the stored symbols for each source symbol, 0 if it can't be decoded
+
+
+plans: OrderedDict[tuple[int, int, int], DecodingPlan] = OrderedDict()
+lock = threading.Lock()
+# plan files in PLAN_DIRECTORY least recently used first, with their sizes, read from the directory when first needed
+# the least recently used are deleted once they add up to more than PLAN_CACHE_DISK_BYTES
+on_disk: OrderedDict[str, int] = None
+disk_bytes = 0
+
+
+def compute(seed: int, num_symbols: int, available: int) -> DecodingPlan:
+	"""Runs the elimination once on the coefficients alone, tracking stored symbol k as bit k of the packets"""
+	decoder = BinaryCoder(num_symbols, available, seed)
+	used = 0
+	while used < available and not decoder.is_fully_decoded():
+		coefficient = decoder.generate_packed_coefficients()
+		decoder.consume_packet(coefficient, 1 << used)
+		used += 1
+	rows = [decoder.get_decoded_symbol(i, packed=True) or 0 for i in range(num_symbols)]
+	return DecodingPlan(used, rows)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def decodable(seed: int, num_symbols: int, minimum: int) -> int:
+	"""Smallest number of stored symbols, at least minimum, whose coefficients reach full rank"""
+	decoder = BinaryCoder(num_symbols, 1, seed)
+	used = 0
+	while not decoder.is_fully_decoded():
+		decoder.consume_packet(decoder.generate_packed_coefficients(), 0)
+		used += 1
+	return max(used, minimum)
+
+
+def plan_path(key: tuple[int, int, int]) -> str:
+	return os.path.join(PLAN_DIRECTORY, "-".join(str(part) for part in key))
+
+
+def disk_index() -> OrderedDict[str, int]:
+	"""Call with lock held"""
+	global on_disk, disk_bytes
+	if on_disk is None:
+		entries = []
+		if os.path.isdir(PLAN_DIRECTORY):
+			for entry in os.scandir(PLAN_DIRECTORY):
+				if not entry.name.startswith(".") and entry.is_file():
+					info = entry.stat()
+					entries.append((info.st_mtime, entry.path, info.st_size))
+		on_disk = OrderedDict((path, size) for _, path, size in sorted(entries))
+		disk_bytes = sum(on_disk.values())
+	return on_disk
+
+
+def track(path: str, size: int):
+	"""Records a plan file as just used, deleting the least recently used ones past PLAN_CACHE_DISK_BYTES"""
+	global disk_bytes
+	evicted = []
+	with lock:
+		index = disk_index()
+		disk_bytes += size - index.pop(path, 0)
+		index[path] = size
+		while disk_bytes > PLAN_CACHE_DISK_BYTES and len(index) > 1:
+			oldest, oldest_size = index.popitem(last=False)
+			disk_bytes -= oldest_size
+			evicted.append(oldest)
+	for oldest in evicted:
+		try:
+			os.remove(oldest)
+		except OSError:
+			pass
+
+
+def forget(keys: list[tuple[int, int, int]]):
+	"""Drops the plans of a removed file's generations, from memory and disk"""
+	global disk_bytes
+	removed = []
+	with lock:
+		for key in keys:
+			plans.pop(key, None)
+			if on_disk is not None and plan_path(key) in on_disk:
+				disk_bytes -= on_disk.pop(plan_path(key))
+			removed.append(plan_path(key))
+	if PLAN_CACHE_ON_DISK:
+		for path in removed:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+def load(key: tuple[int, int, int]) -> DecodingPlan | None:
+	path = plan_path(key)
+	width = (key[2] + 7) // 8
+	try:
+		with open(path, "rb") as file:
+			data = file.read()
+	except OSError:
+		return None
+	track(path, len(data))
+	if len(data) != 4 + key[1] * width:
+		return None
+	used = int.from_bytes(data[:4], "big")
+	rows = [int.from_bytes(data[4 + i * width:4 + (i + 1) * width], "little") for i in range(key[1])]
+	return DecodingPlan(used, rows)
+
+
+def store(key: tuple[int, int, int], plan: DecodingPlan):
+	width = (key[2] + 7) // 8
+	data = plan.used.to_bytes(4, "big") + b"".join(row.to_bytes(width, "little") for row in plan.rows)
+	# each writer has its own temporary file, the plan is only a cache so failing to keep it is not an error
+	try:
+		path = plan_path(key)
+		descriptor, temporary = tempfile.mkstemp(dir=PLAN_DIRECTORY, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+		try:
+			with open(descriptor, "wb") as file:
+				file.write(data)
+			os.replace(temporary, path)
+			track(path, len(data))
+		except BaseException:
+			if os.path.exists(temporary):
+				os.unlink(temporary)
+			raise
+	except OSError as error:
+		if DEBUG: print(f"couldn't store decoding plan {key}: {error}")
+
+
+def get(seed: int, num_symbols: int, available: int) -> DecodingPlan:
+	"""Returns the decoding plan for a generation, from memory, disk or by computing it"""
+	key = (seed, num_symbols, available)
+	with lock:
+		if key in plans:
+			plans.move_to_end(key)
+			return plans[key]
+	plan = load(key) if PLAN_CACHE_ON_DISK else None
+	if plan is None:
+		plan = compute(seed, num_symbols, available)
+		if PLAN_CACHE_ON_DISK:
+			store(key, plan)
+	with lock:
+		plans[key] = plan
+		while len(plans) > PLAN_CACHE_SIZE:
+			plans.popitem(last=False)
+	return plan
+
+
+def apply(plan: DecodingPlan, symbols: bytes, size: int) -> bytes:
+	"""Applies a plan to the first plan.used stored symbols of a generation"""
+	symbols = memoryview(symbols)
+	stored = [int.from_bytes(symbols[i * size:(i + 1) * size], "big") for i in range(plan.used)]
+	output = []
+	for row in plan.rows:
+		value = 0
+		while row:
+			lowest = row & -row
+			value ^= stored[lowest.bit_length() - 1]
+			row ^= lowest
+		output.append(value.to_bytes(size, "big"))
+	return b"".join(output)
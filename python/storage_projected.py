@@ -3,8 +3,6 @@ import os
 import shutil
 import sys
 
-from simplenc import BinaryCoder
-
 try:
 	import ProjectedFS
 except FileNotFoundError:
@@ -16,6 +14,8 @@ except FileNotFoundError:
 	exit()
 import storage_sync
 import storage_backing
+import storage_cache
+import storage_coding
 from constants import *
 from peer import *
 from storage_metadata import *
@@ -151,20 +151,13 @@ def get_file_data(callbackData, byteOffset, length):
 		if length > fileInfo.FileSize:
 			return E_INVALIDARG
 		# read local symbols
-		seed, symbols = storage_backing.read_file(callbackData.contents.FilePathName, 0, length * 2)
-		output = bytearray(length)
-		decoder = BinaryCoder(length, 8, seed)
-		for symbol in symbols:
-			coefficient, _ = decoder.generate_coefficients()
-			decoder.consume_packet(coefficient, [1 if digit == '1' else 0 for digit in format(symbol, "08b")])
-		for i in range(length):
-			if decoder.is_symbol_decoded(i):
-				symbol = decoder.get_decoded_symbol(i)
-				output[i:i+1] = int("".join(map(str, symbol)), 2).to_bytes(1, "big")
-		contents = bytes(output)
+		contents, consumed = storage_backing.read_data(callbackData.contents.FilePathName, byteOffset, length)
+		if DEBUG:
+			print(f"Decoded {callbackData.contents.FilePathName} from {consumed} symbols, cache {storage_cache.stats()}")
+		metadata = load_metadata(path)
 		# read network symbols
 		# TODO: actually use this data
-		network_contents, network_seed = storage_sync.read(callbackData.contents.FilePathName, decoder, length)
+		network_contents, network_seed = storage_sync.read(callbackData.contents.FilePathName, storage_coding.FileDecoder(metadata), storage_coding.requested_size(metadata))
 		writeBuffer = ProjectedFS.PrjAllocateAlignedBuffer(callbackData.contents.NamespaceVirtualizationContext, length)
 		if not writeBuffer:
 			return E_OUTOFMEMORY
@@ -218,11 +211,12 @@ def notified(callbackData, isDirectory, notification, destinationFileName, opera
 			# writes always convert a placeholder into a "full" file (but we still get notifications, etc.)
 			# so we need to be notified of this and rewrite the modified file into the backing store
 			mount_path = os.path.join(MOUNT_POINT, callbackData.contents.FilePathName)
-			size = os.stat(mount_path).st_size
 			with open(mount_path, "rb") as file:
-				data = file.read()
-				seed = storage_backing.write(callbackData.contents.FilePathName, 0, size, data, real_path=mount_path)
-				storage_sync.write(callbackData.contents.FilePathName, seed, data)
+				seed = storage_backing.write_stream(callbackData.contents.FilePathName, file, real_path=mount_path)
+			if peer_list:
+				# peers are sent whole files in one message, so only replication needs the contents in memory
+				with open(mount_path, "rb") as file:
+					storage_sync.write(callbackData.contents.FilePathName, seed, file.read())
 		case ProjectedFS.PRJ_NOTIFICATION_FILE_HANDLE_CLOSED_FILE_DELETED:
 			if DEBUG:
 				print(f"deleted: {callbackData.contents.FilePathName}")
@@ -261,6 +255,8 @@ instanceId.Data3 = 0xCAA7
 def create():
 	storage_backing.ensure(METADATA_DIRECTORY)
 	storage_backing.ensure(SYMBOL_DIRECTORY)
+	if PLAN_CACHE_ON_DISK:
+		storage_backing.ensure(PLAN_DIRECTORY)
 	storage_backing.ensure(MOUNT_POINT)
 
 	if ProjectedFS.PrjMarkDirectoryAsPlaceholder(os.path.abspath(MOUNT_POINT), None, None, instanceId) != S_OK:
@@ -281,6 +277,7 @@ def create():
 
 def destroy():
 	ProjectedFS.PrjStopVirtualizing(instanceHandle)
+	stop_flusher()
 	if DEBUG:
 		print("Stopped virtualization instance")
 	shutil.rmtree(MOUNT_POINT)
@@ -1,15 +1,19 @@
 import os
 import pathlib
 import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from Crypto.Cipher import ChaCha20_Poly1305
 from Crypto.Random import get_random_bytes
 from time import sleep
 
 import storage_backing
+import storage_coding
 
-from storage_metadata import load_metadata, write_metadata
+from storage_metadata import Metadata, load_metadata, write_metadata
+from storage_coding import FileDecoder
 from read_coded import ReadCoded
-from simplenc import BinaryCoder
+from simplenc import BinaryCoder, pack_bits
 from enum import Enum, auto
 from constants import *
 from peer import *
@@ -86,8 +90,73 @@ def thread(function):
 	return run
 
 
-@thread
-def transmit(peer: Peer, command: Command, path: pathlib.PurePosixPath = None, payload = None, **kwargs):
+# Transmissions run on long-lived workers and return futures, rather than starting a thread per call
+# Each peer has one dispatcher, so requests and replies on its TCP connection are never interleaved
+# UDP data is sent from a pool shared by all peers, bounded by TRANSMIT_DATA_THREADS
+# A request that may never be answered needs a timeout, as it holds up every later one to the peer until then
+dispatchers: dict[str, ThreadPoolExecutor] = {}
+data_pool: ThreadPoolExecutor = None
+dispatchers_lock = threading.Lock()
+
+
+def dispatcher(peer: Peer) -> ThreadPoolExecutor:
+	with dispatchers_lock:
+		if peer.uuid not in dispatchers:
+			dispatchers[peer.uuid] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"transmit-{peer.friendly_name}")
+		return dispatchers[peer.uuid]
+
+
+def data_executor() -> ThreadPoolExecutor:
+	global data_pool
+	with dispatchers_lock:
+		if data_pool is None:
+			data_pool = ThreadPoolExecutor(max_workers=TRANSMIT_DATA_THREADS, thread_name_prefix="transmit-data")
+		return data_pool
+
+
+def submit(executor: ThreadPoolExecutor, function, *args, **kwargs) -> Future:
+	def run():
+		try:
+			return function(*args, **kwargs)
+		except Exception:
+			# reported like an uncaught exception in a thread, the result is None as it was from a joined thread
+			traceback.print_exc()
+			return None
+	try:
+		return executor.submit(run)
+	except RuntimeError:
+		# shut down in between, as on exit, refused like a failed transmission
+		future = Future()
+		future.set_result(None)
+		return future
+
+
+def dispatched(function):
+	def run(peer: Peer, *args, **kwargs) -> Future:
+		return submit(dispatcher(peer), function, peer, *args, **kwargs)
+	return run
+
+
+def pooled(function):
+	def run(*args, **kwargs) -> Future:
+		return submit(data_executor(), function, *args, **kwargs)
+	return run
+
+
+def shutdown():
+	"""Lets queued transmissions finish, then stops the workers, later transmissions start new ones"""
+	global data_pool
+	with dispatchers_lock:
+		executors = [executor for executor in [*dispatchers.values(), data_pool] if executor is not None]
+		dispatchers.clear()
+		data_pool = None
+	for executor in executors:
+		executor.shutdown(wait=True)
+
+
+@dispatched
+def transmit(peer: Peer, command: Command, path: pathlib.PurePosixPath = None, payload = None, timeout: float = None, **kwargs):
+	"""Sends a command to a peer over TCP and returns its reply, or None if it takes longer than timeout seconds"""
 	# processing what to send
 	output = "".encode()
 	match command:
@@ -111,11 +180,11 @@ def transmit(peer: Peer, command: Command, path: pathlib.PurePosixPath = None, p
 		case Command.LIST:
 			output = f"{Command.LIST.value}:{path}\n".encode()
 		case Command.READ:
-			payload: BinaryCoder
+			payload: FileDecoder
 			skip = kwargs["skip"]
 			equations = kwargs["equations"]
 			reads[str(path)] = ReadCoded()
-			reads[str(path)].data = bytearray(payload.num_symbols)
+			reads[str(path)].data = bytearray(payload.length)
 			reads[str(path)].decoder = payload
 			output = Command.READ.value.to_bytes(1, "big") + f"{path}{SEP}{skip}{SEP}{equations}\n".encode()
 		case Command.STATS:
@@ -130,53 +199,70 @@ def transmit(peer: Peer, command: Command, path: pathlib.PurePosixPath = None, p
 	else:
 		while peer.connection == None:
 			sleep(0.001)
+		if timeout is not None:
+			peer.connection.settimeout(timeout)
 		peer.connection.sendall(output)
 	# receipt and processing
-	match command:
-		case Command.PAIR:
-			data = peer.connection.recv(1500)
-			data = int.from_bytes(data, "big")
-			return data == 1
-		case Command.CONNECT:
-			data = peer.connection.recv(1500)
-			data = int.from_bytes(data, "big")
-			return data
-		case Command.KEY:
-			return peer.connection.recv(1500)
-		case Command.SYNC:
-			data = peer.connection.recv(1500)
-			data = int.from_bytes(data, "big")
-			return data == 1
-		case Command.READY:
-			data = peer.connection.recv(1500)
-			data = int.from_bytes(data, "big")
-			return data == 1
-		case Command.DISCONNECT:
-			peer.connection.shutdown(socket.SHUT_WR)
-		case Command.LIST:
-			data = peer.connection.recv(1500)
-			data = data.decode().removesuffix("\n")
-			folders, files = data.split(":")
-			folders = folders.split(SEP)
-			files = files.split(SEP)
-			folders = [folder for folder in folders if folder != ""]
-			files = [file for file in files if file != ""]
-			return folders, files
-		case Command.STATS:
-			data = peer.connection.recv(1500)
-			data = data.decode().removesuffix("\n")
-			size, ctime, mtime, atime = data.split(SEP)
-			size = int(size)
-			ctime = int(ctime)
-			mtime = int(mtime)
-			atime = int(atime)
-			return size, ctime, mtime, atime
-
-
-@thread
+	try:
+		match command:
+			case Command.PAIR:
+				data = peer.connection.recv(1500)
+				data = int.from_bytes(data, "big")
+				return data == 1
+			case Command.CONNECT:
+				data = peer.connection.recv(1500)
+				data = int.from_bytes(data, "big")
+				return data
+			case Command.KEY:
+				return peer.connection.recv(1500)
+			case Command.SYNC:
+				data = peer.connection.recv(1500)
+				data = int.from_bytes(data, "big")
+				return data == 1
+			case Command.READY:
+				data = peer.connection.recv(1500)
+				data = int.from_bytes(data, "big")
+				return data == 1
+			case Command.DISCONNECT:
+				peer.connection.shutdown(socket.SHUT_WR)
+			case Command.LIST:
+				data = peer.connection.recv(1500)
+				data = data.decode().removesuffix("\n")
+				folders, files = data.split(":")
+				folders = folders.split(SEP)
+				files = files.split(SEP)
+				folders = [folder for folder in folders if folder != ""]
+				files = [file for file in files if file != ""]
+				return folders, files
+			case Command.STATS:
+				data = peer.connection.recv(1500)
+				data = data.decode().removesuffix("\n")
+				size, ctime, mtime, atime, generation_size, symbol_size, redundancy = data.split(SEP)
+				size = int(size)
+				ctime = int(ctime)
+				mtime = int(mtime)
+				atime = int(atime)
+				generation_size = int(generation_size)
+				symbol_size = int(symbol_size)
+				redundancy = float(redundancy)
+				return size, ctime, mtime, atime, generation_size, symbol_size, redundancy
+
+	except TimeoutError:
+		# a late reply would be taken for the answer to the next request, so the connection can't be used any more
+		print(peer.friendly_name, "didn't answer", command.name, "in time, disconnecting")
+		peer.connection.shutdown(socket.SHUT_RDWR)
+	finally:
+		if timeout is not None:
+			peer.connection.settimeout(None)
+
+
+@pooled
 def transmit_data(peer: Peer, command: Command, path: pathlib.PurePosixPath | str, payload = None, **kwargs):
-	"""Send a file, e.g. a write command, with network-coding and transmit over UDP"""
+	"""Send a file, e.g. a write command, with network-coding and transmit over UDP
+	skip is where the payload starts, length the whole file's length for a write"""
 	seed: int = kwargs["seed"]
+	skip: int = kwargs.get("skip", 0)
+	length: int = kwargs.get("length", 0)
 	payload: bytes
 	# TODO: split data into packet sizes
 	packets = 1
@@ -190,31 +276,39 @@ def transmit_data(peer: Peer, command: Command, path: pathlib.PurePosixPath | st
 	encoder = BinaryCoder(packets, payload_length * 8, 1)
 	coefficient = [0] * encoder.num_symbols
 	coefficient[0] = 1
-	bits = []
-	for byte in ciphertext:
-		bits.extend([byte >> i & 1 for i in range(8 - 1, -1, -1)])
-	encoder.consume_packet(coefficient, bits)
+	encoder.consume_block(coefficient, ciphertext)
 	# fetching encoded data and confirming sufficiently decodes
-	coefficient, packet = encoder.get_sys_coded_packet(0)
-	packet = "".join(map(str, packet))
-	packet = [int(packet[i:i+8], 2) for i in range(0, len(packet), 8)]
-	coefficient = int("".join(map(str, coefficient)), 2)
+	packet = encoder.get_decoded_block(0)
+	coefficient = pack_bits(coefficient)
 	output = command.value.to_bytes(1, "big")
 	output += str(path).encode()
 	output += SEP.encode()
 	output += packets.to_bytes(4, "big")
 	output += payload_length.to_bytes(8, "big")
 	output += seed.to_bytes(8, "big")
+	output += skip.to_bytes(8, "big")
+	output += length.to_bytes(8, "big")
 	output += cipher.nonce  # 24 bytes
 	output += coefficient.to_bytes(4, "big")
-	output += len(bytes(packet)).to_bytes(2, "big")
-	output += bytes(packet)
+	output += len(packet).to_bytes(2, "big")
+	output += packet
 	output += tag  # 16 bytes
 	output += "\n".encode()
 	# transmission
 	peer.data_connection.sendto(output, peer.data_address)
 
 
+def remote_metadata(seed: int, length: int, generation_size: int, symbol_size: int, redundancy: float) -> Metadata:
+	"""Describes the layout of a peer's symbol file, as reported by its stats"""
+	metadata = Metadata()
+	metadata.seed = seed
+	metadata.length = length
+	metadata.generation_size = generation_size
+	metadata.symbol_size = symbol_size
+	metadata.redundancy = redundancy
+	return metadata
+
+
 def explore(path: str):
 	if DEBUG: print("exploring", path)
 	folders, files = list(path)
@@ -237,9 +331,10 @@ def explore(path: str):
 			if DEBUG: print("creating local file:", file)
 			seed = create_local(file, False)
 			if DEBUG: print("requesting remote file:", file)
-			length, ctime, mtime, atime = stats(file)
+			length, ctime, mtime, atime, generation_size, symbol_size, redundancy = stats(file)
 			if DEBUG: print(file, "size is", length, "bytes")
-			contents, seed = read(file, BinaryCoder(length, 8, seed), length * 2)
+			remote = remote_metadata(seed, length, generation_size, symbol_size, redundancy)
+			contents, seed = read(file, FileDecoder(remote), storage_coding.requested_size(remote))
 			metadata = load_metadata(file)
 			metadata.seed = seed
 			write_metadata(file, metadata)
@@ -251,14 +346,15 @@ def explore(path: str):
 			if os.name == "posix":
 				file = path + "/" + file
 			if DEBUG: print(file, "is in both, comparing times")
-			length, ctime, mtime, atime = stats(file)
-			_, _, local_mtime, _ = stats_local(file)
+			length, ctime, mtime, atime, generation_size, symbol_size, redundancy = stats(file)
+			_, _, local_mtime, _, _, _, _ = stats_local(file)
 			if DEBUG: print(local_mtime, mtime)
 			if local_mtime < mtime:
 				# remote version is more recent, we should fetch it
 				if DEBUG: print("fetching more recent remote file:", file)
 				metadata = load_metadata(file)
-				contents, seed = read(file, BinaryCoder(length, 8, metadata.seed), length * 2)
+				remote = remote_metadata(metadata.seed, length, generation_size, symbol_size, redundancy)
+				contents, seed = read(file, FileDecoder(remote), storage_coding.requested_size(remote))
 				metadata.seed = seed
 				write_metadata(file, metadata)
 				write_local(file, 0, len(contents), contents)
@@ -287,8 +383,8 @@ def list(path: str):
 	if DEBUG: print(f"requesting listing of {path}")
 	all_folders = []
 	all_files = []
-	for peer in peer_list:
-		folders, files = transmit(peer, Command.LIST, path).join()
+	for listing in [transmit(peer, Command.LIST, path) for peer in peer_list]:
+		folders, files = listing.result()
 		all_folders.extend(folders)
 		all_files.extend(files)
 	return all_folders, all_files
@@ -298,7 +394,7 @@ def stats(path: str):
 	path = pton(path)
 	if DEBUG: print(f"requesting stats of {path}")
 	for peer in peer_list:
-		return transmit(peer, Command.STATS, path).join()
+		return transmit(peer, Command.STATS, path).result()
 
 
 def create(path: str, directory: bool, seed: int):
@@ -308,7 +404,7 @@ def create(path: str, directory: bool, seed: int):
 		transmit(peer, Command.CREATE, path, "1" if directory else "0", seed=seed)
 
 
-def read(path: str, decoder: BinaryCoder, length: int) -> bytes:
+def read(path: str, decoder: FileDecoder, length: int) -> bytes:
 	path = pton(path)
 	if DEBUG: print(f"reading {path} ({length})")
 	for peer in peer_list:
@@ -323,11 +419,8 @@ def read(path: str, decoder: BinaryCoder, length: int) -> bytes:
 		timeout -= 0.001
 		if timeout < 0:
 			return bytes(), reads[str(path)].decoder.seed
-	for i in range(reads[str(path)].decoder.num_symbols):
-		if reads[str(path)].decoder.is_symbol_decoded(i):
-			symbol = reads[str(path)].decoder.get_decoded_symbol(i)
-			if type(reads[str(path)].data) == bytearray:
-				reads[str(path)].data[i:i+1] = int("".join(map(str, symbol)), 2).to_bytes(1, "big")
+	if type(reads[str(path)].data) == bytearray:
+		reads[str(path)].data[:] = reads[str(path)].decoder.data()
 	contents = bytes(reads[str(path)].data)
 	# del reads[str(path)]
 	return contents, reads[str(path)].decoder.seed
@@ -341,13 +434,18 @@ def rename(path: str, new_path: str):
 		transmit(peer, Command.RENAME, path, new_path)
 
 
-def write(path: str, seed: int, data: bytes):
+def write(path: str, seed: int, data: bytes, offset: int = 0, length: int = None):
+	"""Sends data written at offset to peers, leaving the file length bytes long, by default data is the whole file"""
 	path = pton(path)
-	data = data.replace("\r\n".encode(), "\n".encode())
-	length = len(data)
-	if DEBUG: print(f"writing  {path} ({length}): {data}")
-	for peer in peer_list:
-		transmit_data(peer, Command.WRITE, path, data, seed=seed, skip=0)
+	if length is None:
+		length = offset + len(data)
+	if DEBUG: print(f"writing  {path} ({offset}->{offset+len(data)} of {length}): {data}")
+	data = memoryview(data)
+	# each piece goes in its own datagram, an empty write still sends one to set the length
+	for start in range(0, max(len(data), 1), WRITE_PACKET_BYTES):
+		piece = bytes(data[start:start + WRITE_PACKET_BYTES])
+		for peer in peer_list:
+			transmit_data(peer, Command.WRITE, path, piece, seed=seed, skip=offset + start, length=length)
 
 
 def remove(path: str):
@@ -387,7 +485,7 @@ def create_local(path: str, directory: bool, seed: int = None):
 	if os.name == "nt":
 		return storage_backing.create(path, directory, seed)
 
-def read_local(path: str, skip: int, equations: int) -> bytes:
+def read_local(path: str, skip: int, equations: int) -> tuple[int, memoryview]:
 	if os.name == "nt":
 		path = ntop(path, False)
 	if DEBUG: print(f"reading local {path} ({equations} equations)")
@@ -402,14 +500,21 @@ def rename_local(path: str, new_path: str):
 	storage_backing.rename(path, new_path)
 
 
-def write_local(path: str, start: int, length: int, data: bytes):
+def write_local(path: str, start: int, length: int, data: bytes, file_length: int = None):
+	"""Writes data at start, replacing the whole file unless file_length says how long it is after a partial write"""
 	if os.name == "posix":
 		real_path = path
 	if os.name == "nt":
 		path = ntop(path, False)
 		real_path = ntop(path)
 	if DEBUG: print(f"writing local: {path} ({start}->{start+length}): {data}")
-	storage_backing.write(path, start, length, data, real_path=real_path)
+	if file_length is None or (start == 0 and length == file_length):
+		storage_backing.write(path, start, length, data, truncate=True, real_path=real_path)
+		return
+	if length:
+		storage_backing.write(path, start, length, data, final_length=file_length, real_path=real_path)
+	if load_metadata(path).length != file_length:
+		storage_backing.truncate(path, file_length, real_path=real_path)
 
 
 def remove_local(path: str):